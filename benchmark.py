@@ -0,0 +1,887 @@
+#!/usr/bin/env python3
+from io import BytesIO
+from urllib.parse import quote
+from collections import Counter
+import bisect
+import contextlib
+import gc
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import tempfile
+import textwrap
+import time
+import warnings
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+import PIL
+
+import censorer
+import image_cache
+import images
+import markov
+import markov_compiled
+import markov_migrate
+import metrics
+import stand_in_server
+from markov import MarkovModel, MAX_ORDER
+from markov_compiled import context_key, context_keys
+
+def err_msg():
+    print("Usage: {} train [lines]: compare per-edge, bulk and sharded training throughput\n       {} generate [paragraphs]: compare sqlite and compiled generation speed\n       {} sample [draws]: compare next-word samplers on hub states\n       {} batch [paragraphs]: measure batch generation throughput per process count\n       {} censor [lines]: compare per-word and single-pass censoring\n       {} schema [queries]: compare db size and lookup latency of the old and current schemas\n       {} orders [paragraphs]: compare memory and generation speed of each model order\n       {} memes [count]: compare text meme rendering speed with and without font and layout caching\n       {} imagefetch [memes]: compare text+image meme latency with and without image and search caching\n       {} render [count]: compare one-by-one and batch rendering and encoding of memes\n       {} keywords [texts]: compare list-based and TF-IDF keyword extraction\n       {} metrics [paragraphs]: measure the overhead of metrics hooks, disabled and enabled\n       {} suite [--quick] [--output=<file>] [--baseline=<file>] [--threshold=<percent>] [--save-baseline]: run the seeded training, generation, censor and meme benchmarks, write the results as JSON and compare them against a baseline, exiting with 1 on regressions".format(*[sys.argv[0]] * 13))
+
+# Reads the first n lines of the copypasta corpus the same way markov_train.py
+# does.
+def read_corpus(n=None, filename="data/copypasta.txt"):
+    with open(filename) as f:
+        lines = [l.replace("\r\n"," ").replace("\n"," ") for l in f]
+    return lines[:n] if n else lines
+
+# The original add_text implementation, which does a select and then an insert
+# or update for every edge, on a database with the old schema (see
+# make_old_schema_db). Kept here to measure the bulk path against.
+def legacy_add_text(sqldb, text):
+    words = markov.tokenize(text)
+    con = sqlite3.connect(sqldb)
+    try:
+        cur = con.cursor()
+        for i in range(len(words) - 1):
+            prevword = words[i-1] if i > 0 else None
+            currword = words[i]
+            nextword = words[i+1]
+            cur.execute("select * from edges_first where currword=? and nextword=?;", (currword, nextword))
+            if len(cur.fetchall()) == 0:
+                cur.execute("insert into edges_first (currword, nextword, instances) values (?, ?, 1);", (currword, nextword))
+            else:
+                cur.execute("update edges_first set instances = instances + 1 where currword=? and nextword=?;", (currword, nextword))
+            if prevword:
+                cur.execute("select * from edges_second where prevword=? and currword=? and nextword=?;", (prevword, currword, nextword))
+                if len(cur.fetchall()) == 0:
+                    cur.execute("insert into edges_second (prevword, currword, nextword, instances) values (?, ?, ?, 1);", (prevword, currword, nextword))
+                else:
+                    cur.execute("update edges_second set instances = instances + 1 where prevword=? and currword=? and nextword=?;", (prevword, currword, nextword))
+        con.commit()
+    finally:
+        con.close()
+
+# Times training on the given lines with a fresh database, returning lines/sec.
+def time_training(lines, train):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        train(os.path.join(tmpdir, "bench.sqlite3"), lines)
+        elapsed = time.perf_counter() - start
+    return len(lines) / elapsed
+
+def train_legacy(sqldb, lines):
+    make_old_schema_db(sqldb, [])
+    for l in lines:
+        legacy_add_text(sqldb, l)
+
+def train_bulk(sqldb, lines):
+    with MarkovModel(sqldb) as mm:
+        mm.add_texts(lines)
+
+def train_sharded(sqldb, lines, processes):
+    with MarkovModel(sqldb) as mm:
+        mm.train(lines, processes, chunk_size=max(1, len(lines) // (4 * processes)))
+
+def bench_train(n):
+    lines = read_corpus(n)
+    legacy = time_training(lines, train_legacy)
+    bulk = time_training(lines, train_bulk)
+    print("Training on {} lines".format(len(lines)))
+    print("  per-edge: {:10.1f} lines/sec".format(legacy))
+    print("  bulk:     {:10.1f} lines/sec".format(bulk))
+    print("  speedup:  {:10.1f}x".format(bulk / legacy))
+    processes = 1
+    while processes <= (os.cpu_count() or 1):
+        sharded = time_training(lines, lambda sqldb, lines: train_sharded(sqldb, lines, processes))
+        print("  sharded, {:3} processes: {:10.1f} lines/sec".format(processes, sharded))
+        processes *= 2
+
+# Times generating paragraphs with mm, returning microseconds per token.
+def time_generation(mm, paragraphs):
+    random.seed(0)
+    ntokens = 0
+    start = time.perf_counter()
+    for _ in range(paragraphs):
+        ntokens += len(markov.tokenize(mm.get_random_paragraph_min(50))) - 1
+    return (time.perf_counter() - start) / ntokens * 1e6
+
+def bench_generate(paragraphs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sqldb = os.path.join(tmpdir, "bench.sqlite3")
+        with MarkovModel(sqldb) as mm:
+            mm.add_texts(read_corpus())
+        with MarkovModel(sqldb, censor=False) as mm:
+            sql = time_generation(mm, paragraphs)
+        with MarkovModel(sqldb, censor=False, compiled=True) as mm:
+            start = time.perf_counter()
+            mm.get_compiled_model()
+            load = time.perf_counter() - start
+            compiled = time_generation(mm, paragraphs)
+    print("Generating {} paragraphs".format(paragraphs))
+    print("  sqlite:   {:10.1f} us/token".format(sql))
+    print("  compiled: {:10.1f} us/token (loaded in {:.3f} s)".format(compiled, load))
+    print("  speedup:  {:10.1f}x".format(sql / compiled))
+
+# Next-word samplers for one state of a TransitionTable, for comparison.
+def linear_sampler(table, row):
+    # Like the sqlite path: subtract each edge's probability until one is hit
+    lo, hi = table.offsets[row], table.offsets[row+1]
+    total = table.cumweights[hi-1]
+    rows = [(table.targets[i], (table.cumweights[i] - (table.cumweights[i-1] if i > lo else 0)) / total) for i in range(lo, hi)]
+    def sample():
+        p = random.random()
+        for word, pr in rows:
+            if p < pr:
+                return word
+            p -= pr
+        return rows[-1][0]
+    return sample
+
+def bisect_sampler(table, row):
+    lo, hi = table.offsets[row], table.offsets[row+1]
+    cumweights, targets = table.cumweights, table.targets
+    def sample():
+        return targets[bisect.bisect_right(cumweights, random.random() * cumweights[hi-1], lo, hi)]
+    return sample
+
+def alias_sampler(table, row):
+    return lambda: table.sample(row)
+
+def bench_sample(draws):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sqldb = os.path.join(tmpdir, "bench.sqlite3")
+        with MarkovModel(sqldb, compiled=True) as mm:
+            mm.add_texts(read_corpus())
+            cm = mm.get_compiled_model()
+    print("Sampling {} next words".format(draws))
+    for word in (".", "the", "my"):
+        row = cm.edges.find(context_key([cm.word_ids[word]]))
+        print("  {!r} ({} edges)".format(word, cm.edges.offsets[row+1] - cm.edges.offsets[row]))
+        for name, sampler in (("linear", linear_sampler), ("bisect", bisect_sampler), ("alias", alias_sampler)):
+            sample = sampler(cm.edges, row)
+            start = time.perf_counter()
+            for _ in range(draws):
+                sample()
+            print("    {:7} {:8.3f} us/draw".format(name + ":", (time.perf_counter() - start) / draws * 1e6))
+
+def bench_batch(n):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sqldb = os.path.join(tmpdir, "bench.sqlite3")
+        with MarkovModel(sqldb, compiled=True) as mm:
+            mm.add_texts(read_corpus())
+            mm.get_compiled_model()
+            print("Generating a batch of {} paragraphs".format(n))
+            processes = 1
+            while processes <= (os.cpu_count() or 1):
+                start = time.perf_counter()
+                mm.generate_batch(n, 50, seed=1, processes=processes)
+                print("  {:3} processes: {:10.1f} paragraphs/sec".format(processes, n / (time.perf_counter() - start)))
+                processes *= 2
+
+# The original censor implementation, which runs a separate re.sub for every
+# censor word. Kept here to measure the single-pass censor against.
+def legacy_censor(text, censor_words, vowels_only=True):
+    for censor_word in censor_words:
+        text = re.sub(
+            re.escape(censor_word),
+            censorer._get_censored_word(censor_word, vowels_only),
+            text,
+            flags=re.IGNORECASE
+        )
+    return text
+
+def bench_censor(n):
+    lines = read_corpus(n)
+    rng = random.Random(0)
+    default_words = list(censorer._censor_words)
+    # Pad the default list out with random made-up words
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    big_words = default_words + ["".join(rng.choice(letters) for _ in range(rng.randint(4, 10))) for _ in range(10000)]
+    print("Censoring {} lines".format(len(lines)))
+    for words in (default_words, big_words):
+        # The per-word censor is too slow to run on every line with a big list
+        legacy_lines = lines[:max(10, len(lines) * 100 // len(words))]
+        start = time.perf_counter()
+        for l in legacy_lines:
+            legacy_censor(l, words)
+        legacy = len(legacy_lines) / (time.perf_counter() - start)
+        censorer.set_censor_words(words, replace=True)
+        start = time.perf_counter()
+        censorer.censor("")
+        compile_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for l in lines:
+            censorer.censor(l)
+        single = len(lines) / (time.perf_counter() - start)
+        print("  {} words".format(len(words)))
+        print("    per-word:    {:10.1f} lines/sec".format(legacy))
+        print("    single-pass: {:10.1f} lines/sec (compiled in {:.3f} s)".format(single, compile_time))
+    censorer.set_censor_words(default_words, replace=True)
+
+# Creates a database with the schema from before markov_migrate.py, with the
+# edges of the given lines.
+def make_old_schema_db(sqldb, lines):
+    first_counts, second_counts = markov.count_edges(lines)[:2]
+    con = sqlite3.connect(sqldb)
+    try:
+        cur = con.cursor()
+        cur.execute("create table edges_first (currword varchar, nextword varchar, instances int);")
+        cur.execute("create table edges_second (prevword varchar, currword varchar, nextword varchar, instances int);")
+        cur.execute("create unique index edges_first_edge on edges_first (currword, nextword);")
+        cur.execute("create unique index edges_second_edge on edges_second (prevword, currword, nextword);")
+        cur.executemany("insert into edges_first values (?, ?, ?);", (edge + (n,) for edge, n in first_counts.items()))
+        cur.executemany("insert into edges_second values (?, ?, ?, ?);", (edge + (n,) for edge, n in second_counts.items()))
+        con.commit()
+    finally:
+        con.close()
+    return list(second_counts)
+
+# Times looking up the next words (and their probabilities) of each state with
+# the given query, returning microseconds per lookup.
+def time_lookups(sqldb, query, states):
+    con = sqlite3.connect(sqldb)
+    try:
+        start = time.perf_counter()
+        for state in states:
+            con.execute(query, state).fetchall()
+        return (time.perf_counter() - start) / len(states) * 1e6
+    finally:
+        con.close()
+
+def bench_schema(n):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sqldb = os.path.join(tmpdir, "bench.sqlite3")
+        trigrams = make_old_schema_db(sqldb, read_corpus())
+        rng = random.Random(0)
+        states = [rng.choice(trigrams)[:2] for _ in range(n)]
+        old_size = os.path.getsize(sqldb)
+        old_first = time_lookups(sqldb, "select nextword, cast(instances as float) / (select sum(instances) from edges_first where currword=?2) "
+            "from edges_first where currword=?2;", states)
+        old_second = time_lookups(sqldb, "select nextword, cast(instances as float) / (select sum(instances) from edges_second where prevword=?1 and currword=?2) "
+            "from edges_second where prevword=?1 and currword=?2;", states)
+
+        markov_migrate.migrate(sqldb)
+        new_size = os.path.getsize(sqldb)
+        con = sqlite3.connect(sqldb)
+        word_ids = dict(con.execute("select word, id from vocab;"))
+        con.close()
+        keys = [context_keys([word_ids[prevword], word_ids[currword]]) for prevword, currword in states]
+        query = "select e.nextid, cast(e.instances as float) / s.total from edges e join states s on s.context = e.context where e.context=?;"
+        new_first = time_lookups(sqldb, query, [(first,) for first, _ in keys])
+        new_second = time_lookups(sqldb, query, [(second,) for _, second in keys])
+
+    print("Looking up {} states".format(n))
+    print("  {:8} {:>12} {:>18} {:>18}".format("schema", "size", "first-order", "second-order"))
+    print("  {:8} {:10.1f}MB {:13.1f} us/q {:13.1f} us/q".format("old", old_size / 2**20, old_first, old_second))
+    print("  {:8} {:10.1f}MB {:13.1f} us/q {:13.1f} us/q".format("current", new_size / 2**20, new_first, new_second))
+
+# Returns the number of bytes taken up by a compiled model's transition table
+# and vocabulary.
+def model_size(cm):
+    table = sum(memoryview(getattr(cm.edges, name)).nbytes for name in markov_compiled.TABLE_ARRAYS)
+    return table + sum(sys.getsizeof(word) for word in cm.words) + sys.getsizeof(cm.word_ids)
+
+def bench_orders(paragraphs, min_count=2):
+    lines = read_corpus()
+    print("Generating {} paragraphs per order (pruned: contexts seen fewer than {} times dropped)".format(paragraphs, min_count))
+    print("  {:5} {:>10} {:>12} {:>10} {:>12} {:>12}".format("order", "contexts", "size", "pruned", "pruned size", "us/token"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for order in range(1, MAX_ORDER + 1):
+            sqldb = os.path.join(tmpdir, "bench{}.sqlite3".format(order))
+            with MarkovModel(sqldb, censor=False, compiled=True, order=order) as mm:
+                mm.add_texts(lines)
+                cm = mm.get_compiled_model()
+                contexts, size = len(cm.edges), model_size(cm)
+                mm.prune(min_count)
+                cm = mm.get_compiled_model()
+                us = time_generation(mm, paragraphs)
+                print("  {:5} {:10} {:10.1f}MB {:10} {:10.1f}MB {:12.2f}".format(
+                    order, contexts, size / 2**20, len(cm.edges), model_size(cm) / 2**20, us))
+
+# The original create_text_meme implementation, which loads the font and
+# measures the text with Pillow at every width it tries. Kept here to measure
+# the cached layout and rendering against.
+def legacy_create_text_meme(text):
+    ret_img = Image.new("RGBA", images.IMAGE_SIZE)
+    freesans = ImageFont.truetype("font/FreeSans.ttf", 24)
+    draw = ImageDraw.Draw(ret_img)
+    for char_width in range(60, 1, -1):
+        new_text = '\n'.join(textwrap.wrap(text, width=char_width))
+        width, height = draw.multiline_textsize(new_text, freesans)
+        if width <= images.IMAGE_SIZE[0]-20:
+            break
+    del draw
+    ret_img = ret_img.resize((images.IMAGE_SIZE[0],
+        max(images.IMAGE_SIZE[1],height)+20+images.WATERMARK.size[1]))
+    ret_img.paste("white", (0, 0, ret_img.size[0], ret_img.size[1]))
+    draw = ImageDraw.Draw(ret_img)
+    draw.multiline_text((10,ret_img.size[1]//2 - height//2),
+        new_text, fill="black", font=freesans)
+    del draw
+    ret_img.paste(images.WATERMARK, (0, ret_img.size[1]-images.WATERMARK.size[1]),
+        mask=images.WATERMARK)
+    return ret_img
+
+def bench_memes(n):
+    texts = [l.strip() for l in read_corpus() if l.strip()][:n]
+    # multiline_textsize is deprecated, but it's what the original used
+    warnings.simplefilter("ignore", DeprecationWarning)
+    print("Rendering {} text memes".format(len(texts)))
+    rates = {}
+    results = {}
+    for name, create in (("uncached", legacy_create_text_meme), ("cached", images.create_text_meme)):
+        start = time.perf_counter()
+        results[name] = [create(text) for text in texts]
+        rates[name] = len(texts) / (time.perf_counter() - start)
+        print("  {:9} {:10.1f} memes/sec".format(name + ":", rates[name]))
+    print("  speedup:  {:10.1f}x".format(rates["cached"] / rates["uncached"]))
+    # Text memes have no transparency, so they're drawn in RGB now
+    same = sum(old.size == new.size and ImageChops.difference(old.convert(new.mode), new).getbbox() is None
+        for old, new in zip(results["uncached"], results["cached"]))
+    print("  identical images: {} of {}".format(same, len(texts)))
+
+# Makes a text+image meme of each text, query pair the way copypasta.py does,
+# searching for query and using the first of candidates results that loads.
+# Returns the mean seconds per meme overall and spent rendering.
+def time_image_memes(memes, candidates, search, first_image):
+    total = render = 0
+    # Dead links print errors, which would only clutter the output here
+    with contextlib.redirect_stdout(None):
+        for text, query in memes:
+            start = time.perf_counter()
+            imgs = random.Random(text).sample(search(query), candidates)
+            imgurl = first_image([url for url, _ in imgs])
+            render_start = time.perf_counter()
+            if imgurl is not None:
+                images.create_text_with_image_meme(text, imgurl)
+            render += time.perf_counter() - render_start
+            total += time.perf_counter() - start
+    return total / len(memes), render / len(memes)
+
+def bench_imagefetch(n):
+    # Imported here since it loads the copypasta model
+    import copypasta
+    # Memes are mostly about the same few things, so queries repeat
+    texts = [l.strip() for l in read_corpus() if len(l.split()) > 10][:max(1, n // 4)] * 4
+    random.Random(0).shuffle(texts)
+    memes = [(text, " ".join(copypasta.get_most_common_words(text, 3))) for text in texts]
+    noise = random.Random(0)
+    f = BytesIO()
+    Image.frombytes("RGB", (640, 480), bytes(noise.getrandbits(8) for _ in range(640 * 480 * 3))).save(f, "PNG")
+    stand_in_server.StandInHandler.PNG = f.getvalue()
+    server, server_url = stand_in_server.start()
+    search_url = server_url + "/search?q="
+    search = lambda query: [tuple(result) for result in json.loads(image_cache.fetch(search_url + quote(query)))]
+    print("Making {} text+image memes against a stand-in server with {:.0f} ms latency".format(len(texts), stand_in_server.StandInHandler.NETWORK_LATENCY * 1000))
+    print("  {:16} {:>12} {:>12}".format("", "ms/meme", "rendering"))
+
+    def report(name, total, render):
+        print("  {:16} {:12.1f} {:11.0f}%".format(name, total * 1000, render / total * 100))
+
+    saved_cache = images.IMAGE_CACHE
+    try:
+        # No caching: candidates are tried one after another until one loads
+        images.IMAGE_CACHE = image_cache.ImageCache(max_memory_bytes=0)
+        def first_loading(urls):
+            for url in urls:
+                if images.get_image_from_url(url) is not None:
+                    return url
+        report("uncached", *time_image_memes(memes, copypasta.IMAGE_CANDIDATES, search, first_loading))
+
+        with tempfile.TemporaryDirectory() as tmpdir, image_cache.Prefetcher(images.IMAGE_CACHE) as prefetcher:
+            images.IMAGE_CACHE = prefetcher.cache = image_cache.ImageCache(os.path.join(tmpdir, "images"))
+            search_cache = image_cache.SearchCache(search, os.path.join(tmpdir, "searches"))
+            first_image = lambda urls: prefetcher.first_image(urls)[0]
+            report("cached (cold)", *time_image_memes(memes, copypasta.IMAGE_CANDIDATES, search_cache.get, first_image))
+            report("cached (warm)", *time_image_memes(memes, copypasta.IMAGE_CANDIDATES, search_cache.get, first_image))
+            # A restarted process only has the disk cache to go on
+            images.IMAGE_CACHE = prefetcher.cache = image_cache.ImageCache(os.path.join(tmpdir, "images"))
+            search_cache = image_cache.SearchCache(search, os.path.join(tmpdir, "searches"))
+            report("cached (disk)", *time_image_memes(memes, copypasta.IMAGE_CANDIDATES, search_cache.get, first_image))
+            print("  image cache: {}".format(images.IMAGE_CACHE.stats()))
+    finally:
+        images.IMAGE_CACHE = saved_cache
+        server.shutdown()
+
+def bench_render(n):
+    texts = [l.strip() for l in read_corpus() if l.strip()][:n]
+    # multiline_textsize is deprecated, but it's what the original used
+    warnings.simplefilter("ignore", DeprecationWarning)
+    print("Rendering and encoding {} text memes".format(len(texts)))
+    print("  {:24} {:>12} {:>12}".format("", "memes/sec", "mean size"))
+    start = time.perf_counter()
+    size = 0
+    for text in texts:
+        f = BytesIO()
+        legacy_create_text_meme(text).save(f, "PNG")
+        size += len(f.getvalue())
+    print("  {:24} {:12.1f} {:10.1f}KB".format("one by one (PNG)", len(texts) / (time.perf_counter() - start), size / len(texts) / 1024))
+    processes = 1
+    while processes <= (os.cpu_count() or 1):
+        for format in ("PNG", "WEBP", "JPEG"):
+            start = time.perf_counter()
+            memes = images.render_memes(texts, format=format, processes=processes)
+            print("  {:24} {:12.1f} {:10.1f}KB".format("batch, {} proc ({})".format(processes, format),
+                len(texts) / (time.perf_counter() - start), sum(map(len, memes)) / len(memes) / 1024))
+        processes *= 2
+
+    # A photo much bigger than the meme, as image searches often turn up
+    f = BytesIO()
+    Image.radial_gradient("L").resize((4000, 3000)).convert("RGB").save(f, "JPEG")
+    data = f.getvalue()
+    print("Scaling a {} JPEG for a text+image meme".format("4000x3000"))
+    for name, draft, gap in (("full decode, bicubic", False, None), ("draft decode, reduce", True, images.REDUCING_GAP)):
+        count = 10
+        start = time.perf_counter()
+        for _ in range(count):
+            img = Image.open(BytesIO(data))
+            if draft:
+                img.draft(img.mode, (images.IMAGE_SIZE[0], 1))
+            img.load()
+            img.resize((images.IMAGE_SIZE[0], images.IMAGE_SIZE[0] * img.size[1] // img.size[0]), Image.BICUBIC, reducing_gap=gap)
+        print("  {:24} {:10.1f} ms".format(name, (time.perf_counter() - start) / count * 1000))
+
+# The original get_most_common_words implementation, which checks words
+# against a list of stopwords and ranks them by count alone. Kept here to
+# measure TF-IDF keyword extraction against.
+def legacy_get_most_common_words(text, n, common_words):
+    words = [word.lower() for word in re.findall(r"[A-Za-z'\*\-]+", text)
+        if word.lower() not in common_words and '*' not in word]
+    ctr = Counter(words)
+    return [w for w,_ in ctr.most_common(n)]
+
+def bench_keywords(n):
+    with open("data/mostcommonwords.txt") as f:
+        common_words = [l.strip().lower() for l in f]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with MarkovModel(os.path.join(tmpdir, "bench.sqlite3"), censor=False, compiled=True) as mm:
+            mm.add_texts(read_corpus())
+            start = time.perf_counter()
+            extractor = mm.get_keyword_extractor()
+            load_time = time.perf_counter() - start
+            texts = mm.generate_batch(n, 50, seed=0, processes=1)
+    print("Extracting 3 keywords from {} generated copypastas ({} document frequencies loaded in {:.3f} s)".format(
+        len(texts), len(extractor.doc_freqs), load_time))
+    start = time.perf_counter()
+    legacy = [legacy_get_most_common_words(text, 3, common_words) for text in texts]
+    legacy_us = (time.perf_counter() - start) / len(texts) * 1e6
+    start = time.perf_counter()
+    tfidf = extractor.keywords_batch(texts, 3)
+    tfidf_us = (time.perf_counter() - start) / len(texts) * 1e6
+    print("  list, by count: {:10.1f} us/text".format(legacy_us))
+    print("  TF-IDF:         {:10.1f} us/text".format(tfidf_us))
+    print("  examples (by count -> TF-IDF):")
+    for old, new in list(zip(legacy, tfidf))[:10]:
+        print("    {:40} {}".format(", ".join(old), ", ".join(new)))
+
+def bench_metrics(paragraphs):
+    texts = [l.strip() for l in read_corpus() if l.strip()][:paragraphs]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with MarkovModel(os.path.join(tmpdir, "bench.sqlite3"), compiled=True) as mm:
+            mm.add_texts(read_corpus())
+            print("Generating {} paragraphs and rendering {} memes with metrics disabled and enabled".format(paragraphs, len(texts)))
+            print("  {:10} {:>12} {:>12}".format("metrics", "us/token", "memes/sec"))
+            for enabled in (False, True):
+                if enabled:
+                    with open(os.devnull, "w") as devnull:
+                        metrics.enable(metrics.LogSink(devnull))
+                us = min(time_generation(mm, paragraphs) for _ in range(3))
+                start = time.perf_counter()
+                images.render_memes(texts)
+                memes = len(texts) / (time.perf_counter() - start)
+                print("  {:10} {:12.2f} {:12.1f}".format("enabled" if enabled else "disabled", us, memes))
+            metrics.disable()
+            metrics.reset()
+    count = 1000000
+    start = time.perf_counter()
+    for _ in range(count):
+        metrics.count("bench")
+    print("  disabled metrics.count: {:.0f} ns/call".format((time.perf_counter() - start) / count * 1e9))
+
+# The suite writes its results to SUITE_RESULTS and compares them against
+# SUITE_BASELINE unless told otherwise. Baselines only mean something on the
+# machine they were taken on.
+SUITE_RESULTS = "benchmark_results.json"
+SUITE_BASELINE = "benchmark_baseline.json"
+# Percent a result can get worse by before it counts as a regression
+SUITE_THRESHOLD = 10
+# Most percent of a result's noise (see timing_result) that's allowed on top
+# of the threshold. Results noisier than this can't be told apart from a
+# regression that size, so they're reported as inconclusive rather than ok.
+SUITE_MAX_NOISE = 5
+SUITE_SEED = 0
+# Every measurement is run this many times untimed first
+SUITE_WARMUP = 1
+# Anything quicker than this many seconds is run in a loop until it's taken
+# that long, and timed per run
+SUITE_MIN_TIME = 0.2
+# Iterations of the loop timed by calibrate, a couple of ms' worth, and how
+# many times it's timed
+SUITE_CALIBRATION_LOOPS = 20000
+SUITE_CALIBRATION_SAMPLES = 5
+# Workload sizes for a full run and a --quick one. Results are only compared
+# against baselines taken with the same sizes and settings.
+SUITE_SIZES = {
+    "full": {"train_lines": 2000, "add_text_lines": 200, "paragraphs": 200, "censor_lines": 500, "memes": 100, "repeat": 10},
+    "quick": {"train_lines": 500, "add_text_lines": 50, "paragraphs": 100, "censor_lines": 100, "memes": 25, "repeat": 10},
+}
+# Censor word lists are the default list padded out with made-up words to
+# these multiples of its size, and censored texts are made of this many lines
+SUITE_CENSOR_WORD_MULTIPLES = (1, 10, 100)
+SUITE_CENSOR_TEXT_LINES = (1, 10, 100)
+
+# Times a fixed bit of pure Python work, to tell how fast the machine is
+# running right now. Shared machines speed up and slow down by a lot more
+# than the regressions worth catching, over a few seconds at a time. Returns
+# the mean of a few tries, since a timed run goes at the machine's average
+# speed rather than its fastest.
+def calibrate():
+    start = time.perf_counter()
+    for _ in range(SUITE_CALIBRATION_SAMPLES):
+        total = 0
+        for i in range(SUITE_CALIBRATION_LOOPS):
+            total += i * i
+    return (time.perf_counter() - start) / SUITE_CALIBRATION_SAMPLES
+
+# Runs func SUITE_WARMUP times untimed, then repeat times timed. Returns
+# (seconds, calibration seconds) for each timed run, and what each returned.
+# The calibration is taken both before and after the run. With setup, it's
+# called untimed before each run and what it returns is passed to func;
+# otherwise quick runs are looped (see SUITE_MIN_TIME).
+def time_runs(func, repeat, setup=None):
+    times, results = [], []
+    for i in range(SUITE_WARMUP + repeat):
+        args = (setup(),) if setup else ()
+        before = calibrate()
+        calls = 0
+        # Like timeit, keep collections from landing on random runs
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            while True:
+                result = func(*args)
+                calls += 1
+                elapsed = time.perf_counter() - start
+                if setup or elapsed >= SUITE_MIN_TIME:
+                    break
+        finally:
+            gc.enable()
+        calibration = (before + calibrate()) / 2
+        if i >= SUITE_WARMUP:
+            times.append((elapsed / calls, calibration))
+            results.append(result)
+    return times, results
+
+# Returns a result entry for the (seconds, calibration seconds) of several
+# runs: the median of their times for how fast the machine was going, as a
+# rate of work per second, or in ms without work. The fastest run would
+# mostly pick out runs whose calibration happened to come out slow. The
+# median calibration is kept so it can be compared with runs on a machine
+# going at another speed. Its noise is how much slower the upper quartile run
+# was than the median in the same terms, in percent.
+def timing_result(times, unit, work=None):
+    relative = [seconds / calibration for seconds, calibration in times]
+    median = statistics.median(relative)
+    calibration = statistics.median(calibration for _, calibration in times)
+    seconds = median * calibration
+    noise = (statistics.quantiles(relative, n=4)[2] / median - 1) * 100
+    if work is None:
+        return {"value": seconds * 1e3, "unit": unit, "better": "lower", "noise": noise, "calibration": calibration}
+    return {"value": work / seconds, "unit": unit, "better": "higher", "noise": noise, "calibration": calibration}
+
+# Returns a result entry for the pth percentile of how long paragraphs took,
+# from the (latencies in seconds, calibration seconds) of runs generating the
+# same paragraphs. Each paragraph's median time, for how fast the machine was
+# going, is taken before working out the percentile, which keeps one-off
+# stalls out of it. Its noise is how much higher the percentile comes out
+# with any one run left out.
+def latency_result(runs, p):
+    def percentile(runs):
+        typical = [statistics.median(latencies[i] / calibration for latencies, calibration in runs) for i in range(len(runs[0][0]))]
+        return statistics.quantiles(typical, n=100)[p - 1]
+    value = percentile(runs)
+    worst = max(percentile(runs[:i] + runs[i + 1:]) for i in range(len(runs)))
+    calibration = statistics.median(calibration for _, calibration in runs)
+    return {"value": value * calibration * 1e3, "unit": "ms", "better": "lower", "noise": (worst / value - 1) * 100, "calibration": calibration}
+
+def print_suite_result(name, result):
+    print("  {:44} {:12.2f} {:10} (noise {:.1f}%)".format(name, result["value"], result["unit"], result["noise"]))
+
+def digest(texts):
+    h = hashlib.sha256()
+    for text in texts:
+        h.update(text if isinstance(text, bytes) else text.encode())
+    return h.hexdigest()
+
+def train_add_text(sqldb, lines):
+    with MarkovModel(sqldb) as mm:
+        for l in lines:
+            mm.add_text(l)
+
+# The same as markov_train.py, but on one process so the result doesn't depend
+# on the number of cores
+def train_markov_train(sqldb, lines):
+    with MarkovModel(sqldb) as mm:
+        mm.train(lines, processes=1)
+
+def suite_train(sizes, results):
+    lines = read_corpus(sizes["train_lines"])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Every run starts from an empty database
+        def fresh_db():
+            for name in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, name))
+            return os.path.join(tmpdir, "bench.sqlite3")
+        for name, train, n in (
+            ("train.add_text", train_add_text, sizes["add_text_lines"]),
+            ("train.add_texts", train_bulk, len(lines)),
+            ("train.markov_train", train_markov_train, len(lines)),
+        ):
+            times, _ = time_runs(lambda sqldb: train(sqldb, lines[:n]), sizes["repeat"], fresh_db)
+            results[name] = timing_result(times, "lines/sec", n)
+            print_suite_result(name, results[name])
+
+# Generates paragraphs with mm from a fresh seeded RNG. Returns how long each
+# took in seconds and the paragraphs, which are the same every time.
+def generate_paragraphs(mm, paragraphs, wordmin=50):
+    rng = random.Random(SUITE_SEED)
+    latencies, texts = [], []
+    for _ in range(paragraphs):
+        start = time.perf_counter()
+        texts.append(mm.get_random_paragraph_min(wordmin, rng=rng))
+        latencies.append(time.perf_counter() - start)
+    return latencies, texts
+
+def load_compiled(sqldb):
+    with MarkovModel(sqldb, censor=False, compiled=True) as mm:
+        mm.get_compiled_model()
+
+def suite_generate(sizes, results, digests):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sqldb = os.path.join(tmpdir, "bench.sqlite3")
+        with MarkovModel(sqldb) as mm:
+            mm.add_texts(read_corpus())
+        times, _ = time_runs(lambda: load_compiled(sqldb), sizes["repeat"])
+        results["generate.compiled.load"] = timing_result(times, "ms")
+        print_suite_result("generate.compiled.load", results["generate.compiled.load"])
+        for backend, compiled in (("sqlite", False), ("compiled", True)):
+            with MarkovModel(sqldb, censor=False, compiled=compiled) as mm:
+                times, runs = time_runs(lambda: generate_paragraphs(mm, sizes["paragraphs"]), sizes["repeat"])
+            texts = runs[-1][1]
+            prefix = "generate." + backend
+            results[prefix + ".tokens"] = timing_result(times, "tokens/sec", sum(len(markov.tokenize(text)) - 1 for text in texts))
+            latencies = [(latencies, calibration) for (latencies, _), (_, calibration) in zip(runs, times)]
+            for p in (50, 90, 99):
+                results["{}.paragraph_p{}".format(prefix, p)] = latency_result(latencies, p)
+            for name in sorted(name for name in results if name.startswith(prefix + ".") and name != "generate.compiled.load"):
+                print_suite_result(name, results[name])
+            digests[prefix] = digest(texts)
+
+def censor_texts(texts):
+    rng = random.Random(SUITE_SEED)
+    return [censorer.censor(text, rng=rng) for text in texts]
+
+def suite_censor(sizes, results, digests):
+    lines = [l.strip() for l in read_corpus(sizes["censor_lines"])]
+    saved_words = list(censorer._censor_words)
+    with open("data/censorlist.txt") as f:
+        default_words = [l.strip() for l in f]
+    rng = random.Random(SUITE_SEED)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    padding = ["".join(rng.choice(letters) for _ in range(rng.randint(4, 10)))
+        for _ in range(len(default_words) * (max(SUITE_CENSOR_WORD_MULTIPLES) - 1))]
+    try:
+        for multiple in SUITE_CENSOR_WORD_MULTIPLES:
+            words = default_words + padding[:len(default_words) * (multiple - 1)]
+            censorer.set_censor_words(words, replace=True)
+            times, _ = time_runs(censorer._compile_censor_words, sizes["repeat"])
+            name = "censor.{}_words.compile".format(len(words))
+            results[name] = timing_result(times, "ms")
+            print_suite_result(name, results[name])
+            for text_lines in SUITE_CENSOR_TEXT_LINES:
+                texts = [" ".join(lines[i:i + text_lines]) for i in range(0, len(lines), text_lines)]
+                times, runs = time_runs(lambda: censor_texts(texts), sizes["repeat"])
+                name = "censor.{}_words.{}_line_texts".format(len(words), text_lines)
+                results[name] = timing_result(times, "chars/sec", sum(len(text) for text in texts))
+                print_suite_result(name, results[name])
+                digests[name] = digest(runs[-1])
+    finally:
+        censorer.set_censor_words(saved_words or None, replace=True)
+
+def suite_memes(sizes, results, digests):
+    texts = [l.strip() for l in read_corpus() if l.strip()][:sizes["memes"]]
+    times, runs = time_runs(lambda: [images.create_text_meme(text) for text in texts], sizes["repeat"])
+    results["memes.create_text_meme"] = timing_result(times, "memes/sec", len(texts))
+    print_suite_result("memes.create_text_meme", results["memes.create_text_meme"])
+    digests["memes.create_text_meme"] = digest(meme.tobytes() for meme in runs[-1])
+
+# Compares results against baseline, both as written by bench_suite. Returns
+# (name, baseline value, value, percent change, percent allowed, status) for
+# every result in either. Changes are worked out as if the machine had been
+# going at the same speed for both (see calibrate). A result is allowed to
+# get worse by threshold percent plus the noise of the noisier of the two
+# runs, up to max_noise percent of it; status is "regressed" if it got worse
+# by more than that, "improved" if it got better by more, "inconclusive" if
+# neither but it was noisier than max_noise, "ok" otherwise and "new" or
+# "missing" if it's only in one of them.
+def compare_results(results, baseline, threshold, max_noise=SUITE_MAX_NOISE):
+    rows = []
+    for name in sorted(set(results["results"]) | set(baseline["results"])):
+        new, old = results["results"].get(name), baseline["results"].get(name)
+        if old is None:
+            rows.append((name, None, new["value"], None, None, "new"))
+        elif new is None:
+            rows.append((name, old["value"], None, None, None, "missing"))
+        else:
+            noise = max(new["noise"], old["noise"])
+            allowed = threshold + min(noise, max_noise)
+            # How much slower the machine was going, for the new result
+            slowdown = new["calibration"] / old["calibration"]
+            if new["better"] == "higher":
+                adjusted = new["value"] * slowdown
+            else:
+                adjusted = new["value"] / slowdown
+            change = (adjusted - old["value"]) / old["value"] * 100 if old["value"] else 0
+            worse = -change if new["better"] == "higher" else change
+            if worse > allowed:
+                status = "regressed"
+            elif -worse > allowed:
+                status = "improved"
+            else:
+                status = "inconclusive" if noise > max_noise else "ok"
+            rows.append((name, old["value"], new["value"], change, allowed, status))
+    return rows
+
+# Runs the whole suite with fixed seeds, writes the results to output and, if
+# there's a baseline with the same config, compares them against it. Returns
+# the exit status: 1 if anything regressed, 0 otherwise.
+def bench_suite(quick=False, output=SUITE_RESULTS, baseline_file=SUITE_BASELINE, threshold=SUITE_THRESHOLD, save_baseline=False):
+    sizes = SUITE_SIZES["quick" if quick else "full"]
+    random.seed(SUITE_SEED)
+    results = {
+        "version": 2,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "pillow": PIL.__version__,
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "config": {"seed": SUITE_SEED, "sizes": sizes, "warmup": SUITE_WARMUP, "min_time": SUITE_MIN_TIME, "calibration_loops": SUITE_CALIBRATION_LOOPS, "calibration_samples": SUITE_CALIBRATION_SAMPLES},
+        "results": {},
+        "digests": {},
+    }
+    print("Running the {} benchmark suite".format("quick" if quick else "full"))
+    suite_train(sizes, results["results"])
+    suite_generate(sizes, results["results"], results["digests"])
+    suite_censor(sizes, results["results"], results["digests"])
+    suite_memes(sizes, results["results"], results["digests"])
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(output))
+    if save_baseline:
+        with open(baseline_file, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Baseline written to {}".format(baseline_file))
+        return 0
+
+    try:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print("No baseline at {}; run with --save-baseline to store one".format(baseline_file))
+        return 0
+    if baseline.get("config") != results["config"]:
+        print("Baseline {} was taken with a different config, not comparing".format(baseline_file))
+        return 0
+    print("Compared to {} (taken {}, {}% threshold plus up to {}% noise)".format(baseline_file, baseline["time"], threshold, SUITE_MAX_NOISE))
+    print("Changes are adjusted for how fast the machine was going each time")
+    print("  {:44} {:>12} {:>12} {:>8} {:>8}".format("result", "baseline", "now", "change", "allowed"))
+    rows = compare_results(results, baseline, threshold)
+    for name, old, new, change, allowed, status in rows:
+        print("  {:44} {:>12} {:>12} {:>8} {:>8} {}".format(name,
+            "-" if old is None else "{:.2f}".format(old),
+            "-" if new is None else "{:.2f}".format(new),
+            "-" if change is None else "{:+.1f}%".format(change),
+            "-" if allowed is None else "{:.1f}%".format(allowed),
+            status if status != "ok" else ""))
+    # Same seeds and sizes should give the same output, so a change here means
+    # the code now does something different, which is worth knowing when
+    # comparing speed
+    for name, value in sorted(results["digests"].items()):
+        if baseline["digests"].get(name, value) != value:
+            print("  output of {} differs from the baseline".format(name))
+    inconclusive = [row[0] for row in rows if row[5] == "inconclusive"]
+    if inconclusive:
+        print("{} result(s) too noisy to rule out a regression: {}".format(len(inconclusive), ", ".join(inconclusive)))
+    regressions = [row[0] for row in rows if row[5] == "regressed"]
+    if regressions:
+        print("{} regression(s) past {}%: {}".format(len(regressions), threshold, ", ".join(regressions)))
+        return 1
+    print("No regressions past {}%".format(threshold))
+    return 0
+
+# Parses the suite's options into bench_suite's keyword arguments. Raises
+# ValueError for anything it doesn't know.
+def parse_suite_args(args):
+    options = {}
+    for arg in args:
+        if arg == "--quick":
+            options["quick"] = True
+        elif arg == "--save-baseline":
+            options["save_baseline"] = True
+        elif arg.startswith("--output="):
+            options["output"] = arg[len("--output="):]
+        elif arg.startswith("--baseline="):
+            options["baseline_file"] = arg[len("--baseline="):]
+        elif arg.startswith("--threshold="):
+            options["threshold"] = float(arg[len("--threshold="):])
+        else:
+            raise ValueError("unknown suite option {!r}".format(arg))
+    return options
+
+if __name__ == "__main__":
+    if len(sys.argv) in (2, 3) and sys.argv[1] == "train":
+        bench_train(int(sys.argv[2]) if len(sys.argv) == 3 else 500)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "generate":
+        bench_generate(int(sys.argv[2]) if len(sys.argv) == 3 else 20)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "sample":
+        bench_sample(int(sys.argv[2]) if len(sys.argv) == 3 else 100000)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "batch":
+        bench_batch(int(sys.argv[2]) if len(sys.argv) == 3 else 2000)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "censor":
+        bench_censor(int(sys.argv[2]) if len(sys.argv) == 3 else 500)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "schema":
+        bench_schema(int(sys.argv[2]) if len(sys.argv) == 3 else 2000)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "orders":
+        bench_orders(int(sys.argv[2]) if len(sys.argv) == 3 else 200)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "memes":
+        bench_memes(int(sys.argv[2]) if len(sys.argv) == 3 else 200)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "imagefetch":
+        bench_imagefetch(int(sys.argv[2]) if len(sys.argv) == 3 else 100)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "render":
+        bench_render(int(sys.argv[2]) if len(sys.argv) == 3 else 200)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "keywords":
+        bench_keywords(int(sys.argv[2]) if len(sys.argv) == 3 else 1000)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "metrics":
+        bench_metrics(int(sys.argv[2]) if len(sys.argv) == 3 else 200)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "suite":
+        try:
+            options = parse_suite_args(sys.argv[2:])
+        except ValueError as e:
+            print("Error:", e)
+            err_msg()
+            sys.exit(2)
+        sys.exit(bench_suite(**options))
+    else:
+        err_msg()
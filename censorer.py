@@ -1,8 +1,19 @@
 import random
 import re
 
+import metrics
+
 _censor_words = []
 _censor_chars = ['*']
+# Single regex finding every censor word, the same for just the censor words
+# that can't appear inside a single word, and the positions in _censor_words
+# of the censor words found inside each (lowercased) word they can match.
+# Built by _compile_censor_words whenever _censor_words changes.
+_censor_regex = None
+_spanning_regex = None
+_censor_subwords = {}
+# Characters that words are made of (see markov.WORD_REGEX)
+_WORD_REGEX = re.compile(r"[A-Za-z0-9\-\']+")
 
 # Sets the censor characters based on a list (or string) of characters.
 def set_censor_chars(chars_list=['*'], replace=True):
@@ -21,7 +32,7 @@ def set_censor_chars(chars_list=['*'], replace=True):
 # Sets the censor words based on a list of words. None will use the default word
 # list from censorlist.txt.
 def set_censor_words(word_list=None, replace=False):
-    global _censor_words
+    global _censor_words, _censor_regex
     if not word_list:
         with open("data/censorlist.txt") as f:
             word_list = [l.strip() for l in f]
@@ -29,27 +40,122 @@ def set_censor_words(word_list=None, replace=False):
         _censor_words = word_list
     else:
         _censor_words += word_list
+    _censor_regex = None
 
-# Censors the given text using _censor_words.
-def censor(text, vowels_only=True):
+# Censors the given text using _censor_words. spanning_only set to True only
+# censors words that can't be found inside a single word, such as "blow job";
+# this is for text made of words that have been censored already.
+def censor(text, vowels_only=True, rng=random, spanning_only=False):
     # If we have no censor words, load the default list
     if not _censor_words:
         set_censor_words()
-    for censor_word in _censor_words:
-        text = re.sub(
-            re.escape(censor_word),
-            _get_censored_word(censor_word, vowels_only),
-            text,
-            flags=re.IGNORECASE
-        )
-    return text
+    if _censor_regex is None:
+        _compile_censor_words()
+
+    # Censored versions of each censor word, made at most once per call
+    censored = {}
+    def get_censored(word):
+        if word not in censored:
+            censored[word] = _get_censored_word(word, vowels_only, rng)
+        return censored[word]
+
+    # Censors the words in span (matched, as in the text, by the regex) one
+    # by one in list order, the same as censoring the whole text a word at a
+    # time would
+    def replace(span, matched):
+        indices = set()
+        for word in matched:
+            # Words the regex matches case-insensitively but that don't lower
+            # to a censor word (like "ſex") could be any of them
+            indices.update(_censor_subwords.get(word.lower(), range(len(_censor_words))))
+        if len(matched) == 1 and len(indices) == 1:
+            return get_censored(_censor_words[indices.pop()])
+        for i in sorted(indices):
+            word = _censor_words[i]
+            if word:
+                span = re.sub(re.escape(word), get_censored(word), span, flags=re.IGNORECASE)
+        return span
+
+    # The longest censor word starting at each position, including ones
+    # overlapping each other (like "shit" and "twat" in "shitwat"). Runs of
+    # overlapping matches are censored together.
+    parts = []
+    copied = 0
+    start = end = None
+    for match in (_spanning_regex if spanning_only else _censor_regex).finditer(text):
+        s, e = match.span(1)
+        if start is not None and s < end:
+            # Anything ending before the end of the run is inside an earlier
+            # match, so it's one of that match's subwords already
+            if e > end:
+                matched.append(match.group(1))
+                end = e
+            continue
+        if start is not None:
+            parts += [text[copied:start], replace(text[start:end], matched)]
+            copied = end
+        start, end, matched = s, e, [match.group(1)]
+    if start is None:
+        return text
+    parts += [text[copied:start], replace(text[start:end], matched), text[end:]]
+    return "".join(parts)
+
+# Builds _censor_regex, which finds the longest censor word starting at every
+# position in one pass. The pattern is generated from a trie of the words so
+# each position is checked a character at a time instead of word by word,
+# which keeps it fast with very long word lists.
+@metrics.timed("censor.compile")
+def _compile_censor_words():
+    global _censor_regex, _spanning_regex, _censor_subwords
+    trie, spanning_trie = {}, {}
+    positions = {}
+    for i, word in enumerate(_censor_words):
+        if not word:
+            continue
+        positions.setdefault(word.lower(), []).append(i)
+        _add_to_trie(trie, word.lower())
+        if not _WORD_REGEX.fullmatch(word):
+            _add_to_trie(spanning_trie, word.lower())
+
+    _censor_subwords = {}
+    for lowered in positions:
+        found = set()
+        for start in range(len(lowered)):
+            for end in range(start + 1, len(lowered) + 1):
+                found.update(positions.get(lowered[start:end], ()))
+        # Keep the first of any exact duplicates
+        subwords = {}
+        for i in sorted(found):
+            subwords.setdefault(_censor_words[i], i)
+        _censor_subwords[lowered] = list(subwords.values())
+
+    # The words are matched inside a lookahead so that matches can overlap
+    _censor_regex = re.compile("(?=({}))".format(_trie_pattern(trie) or "(?!)"), flags=re.IGNORECASE)
+    _spanning_regex = re.compile("(?=({}))".format(_trie_pattern(spanning_trie) or "(?!)"), flags=re.IGNORECASE)
+
+def _add_to_trie(trie, word):
+    node = trie
+    for c in word:
+        node = node.setdefault(c, {})
+    node[""] = {}
+
+# Converts a trie of characters (with "" marking the end of a word) to a regex
+# that greedily matches the longest word in it.
+def _trie_pattern(node):
+    branches = [re.escape(c) + _trie_pattern(child) for c, child in sorted(node.items()) if c]
+    if not branches:
+        return ""
+    pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    if "" in node:
+        pattern = "(?:" + pattern + ")?"
+    return pattern
     
 # Get a censored version of the word inputted, using _censor_chars.
-def _get_censored_word(word, vowels_only=True):
+def _get_censored_word(word, vowels_only=True, rng=random):
     censor = []
     while len(censor) < len(word):
         # Keep on adding shuffled _censor_chars until we're longer than word
-        censor += random.sample(_censor_chars, k=len(_censor_chars))
+        censor += rng.sample(_censor_chars, k=len(_censor_chars))
     # Replace censor chars with consonants where applicable
     if vowels_only:
         for i,c in enumerate(word):
@@ -1,48 +1,88 @@
-from collections import Counter
 import random
-import re
+import sys
+import time
 
 import images
+import metrics
 from markov import MarkovModel
 
-PASTA_MM = MarkovModel("data/copypasta.sqlite3")
+PASTA_MM = MarkovModel("data/copypasta.sqlite3", compiled=True, model_filename="data/copypasta.model")
 MEAN_WORDS_PER_PARAGRAPH = 50
 STDEV_WORDS_PER_PARAGRAPH = 20
-with open("data/mostcommonwords.txt") as f:
-    COMMON_WORDS = [l.strip().lower() for l in f]
+# Number of image search results to download at once for a text+image meme
+IMAGE_CANDIDATES = 4
+# Loaded from PASTA_MM the first time keywords are needed
+_keyword_extractor = None
 
 def generate_copypasta(short=False):
-    wordmin = discrete_normal(
+    return PASTA_MM.get_random_paragraph_min(random_wordmin(short))
+
+# Generates n copypastas at once, spread over a pool of processes. The output
+# only depends on seed.
+def generate_batch(n, short=False, seed=None, processes=None):
+    if seed is None:
+        seed = random.getrandbits(64)
+    rng = random.Random(seed)
+    wordmins = [random_wordmin(short, rng) for _ in range(n)]
+    return PASTA_MM.generate_batch(n, wordmins, seed, processes)
+
+# Generates n copypastas with generate_batch and renders each into a text
+# meme, returned encoded as format (see images.encode_image).
+def generate_memes(n, short=False, seed=None, processes=1, format="PNG", **options):
+    return images.render_memes(generate_batch(n, short, seed, processes), format=format, processes=processes, **options)
+
+# Picks a random minimum number of words for a copypasta.
+def random_wordmin(short=False, rng=random):
+    return discrete_normal(
         mu=MEAN_WORDS_PER_PARAGRAPH - (45 if short else 0),
         sigma=STDEV_WORDS_PER_PARAGRAPH - (10 if short else 0),
-        minimum=1
+        minimum=1,
+        rng=rng
     )
-    return PASTA_MM.get_random_paragraph_min(wordmin)
 
-# Gets n most common words from text, barring most common words in English.
+def get_keyword_extractor():
+    global _keyword_extractor
+    if _keyword_extractor is None:
+        _keyword_extractor = PASTA_MM.get_keyword_extractor()
+    return _keyword_extractor
+
+# Gets the n words that best describe text (barring most common words in
+# English), weighting how often they appear in it by how rare they are in the
+# copypasta corpus.
+@metrics.timed("keywords.extract")
 def get_most_common_words(text, n):
-    words = [word.lower() for word in re.findall(r"[A-Za-z'\*\-]+", text)
-        if word.lower() not in COMMON_WORDS and '*' not in word]
-    ctr = Counter(words)
-    return [w for w,_ in ctr.most_common(n)]
+    return get_keyword_extractor().keywords(text, n)
+
+# get_most_common_words for each of texts.
+def get_most_common_words_batch(texts, n):
+    return get_keyword_extractor().keywords_batch(texts, n)
 
-def discrete_normal(mu, sigma, minimum=-float('inf')):
-    retval = round(random.gauss(mu,sigma))
+def discrete_normal(mu, sigma, minimum=-float('inf'), rng=random):
+    retval = round(rng.gauss(mu,sigma))
     return minimum if minimum > retval else retval
 
+def err_msg():
+    print("Usage: {} [--profile[=<file>]] [--metrics=<sink>]: try out copypasta and memes interactively\n       {} [--profile[=<file>]] [--metrics=<sink>] memes <count>: render count memes in a batch\n       (see metrics.parse_args for the options)".format(*[sys.argv[0]] * 2))
+
 # FOR TESTING ONLY
-if __name__ == "__main__":
+def test_loop():
     i = 1
     while True:
-        inpt = input("1 for text, 2 for text+image: ")
+        try:
+            inpt = input("1 for text, 2 for text+image: ")
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return
         if inpt == '2':
             pasta = generate_copypasta(short=True)
             print(pasta)
             words = get_most_common_words(pasta,3)
             print(words)
             imgs = images.get_google_images(' '.join(words))
-            # images.get_image_from_url(random.choice(images)[0]).show()
-            meem = images.create_text_with_image_meme(pasta, random.choice(imgs)[0])
+            # Try a few of the results at once, since some are always dead
+            candidates = random.sample(imgs, min(IMAGE_CANDIDATES, len(imgs)))
+            imgurl, _ = images.get_first_image([url for url, _ in candidates])
+            meem = images.create_text_with_image_meme(pasta, imgurl) if imgurl else None
             if meem:
                 meem.show()
                 meem.save("testmeem_" + str(i) + ".png")
@@ -52,4 +92,28 @@ if __name__ == "__main__":
             meem = images.create_text_meme(pasta)
             meem.show()
             meem.save("testmeem_" + str(i) + ".png")
-        i += 1
\ No newline at end of file
+        i += 1
+
+def render_batch(n):
+    start = time.perf_counter()
+    memes = generate_memes(n)
+    elapsed = time.perf_counter() - start
+    print("Rendered {} memes ({} bytes) in {:.2f} s".format(len(memes), sum(map(len, memes)), elapsed))
+
+if __name__ == "__main__":
+    try:
+        profile_to = metrics.parse_args(sys.argv)
+    except ValueError as e:
+        print("Error:", e)
+        sys.exit(1)
+    if len(sys.argv) == 1:
+        main, args = test_loop, ()
+    elif len(sys.argv) == 3 and sys.argv[1] == "memes":
+        main, args = render_batch, (int(sys.argv[2]),)
+    else:
+        err_msg()
+        sys.exit(1)
+    if profile_to:
+        metrics.profile(main, *args, filename=profile_to if profile_to is not True else None)
+    else:
+        main(*args)
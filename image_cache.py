@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, as_completed
+from io import BytesIO
+from PIL import Image
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request as request
+
+import metrics
+
+FETCH_TIMEOUT = 10
+FETCH_RETRIES = 2
+# Seconds before the first retry, doubling after that
+RETRY_BACKOFF = 0.5
+# Urls that failed to load aren't tried again for this many seconds
+FAILURE_TTL = 10 * 60
+# Search results are scraped again after this many seconds
+SEARCH_TTL = 24 * 60 * 60
+
+def err_msg():
+    print("Usage: {} <cache dir> <image url> [image url...]: download images into a cache and print its stats".format(sys.argv[0]))
+
+# Downloads url and returns its content. Network errors and 429 and 5xx
+# responses are retried up to retries times, with exponential backoff; the
+# last error is raised if they all fail.
+@metrics.timed("images.fetch")
+def fetch(url, headers={}, timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES):
+    for attempt in range(retries + 1):
+        try:
+            with request.urlopen(request.Request(url, headers=headers), timeout=timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if (e.code < 500 and e.code != 429) or attempt == retries:
+                raise
+        # Timeouts are OSErrors too
+        except (urllib.error.URLError, OSError):
+            if attempt == retries:
+                raise
+        metrics.count("images.fetch_retries")
+        time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+def _digest(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+# Writes data to path under another name first, so a crash never leaves a
+# partial file behind.
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+# Caches images by url, decoded in memory and as downloaded on disk, each up to
+# a size limit past which the least recently used ones are evicted. Disk files
+# are content-addressed: objects/<sha256 of the data> holds the data and
+# urls/<sha256 of the url> the digest of what the url returned, so urls with
+# the same image share one copy. Without a cache_dir, only memory is used.
+# With draft_size set, JPEGs are decoded at the smallest fraction of their size
+# that's still at least that big, which is much faster for large ones.
+#
+# Safe to use from several threads; concurrent requests for the same url share
+# one download.
+class ImageCache:
+    def __init__(self, cache_dir=None, max_disk_bytes=256 * 2**20, max_memory_bytes=64 * 2**20, fetch=fetch, failure_ttl=FAILURE_TTL, draft_size=None):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.fetch = fetch
+        self.failure_ttl = failure_ttl
+        self.draft_size = draft_size
+        self.lock = threading.Lock()
+        # url -> (image, decoded size), least recently used first
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        # digest -> size of the objects on disk, least recently used first
+        self.objects = OrderedDict()
+        self.disk_bytes = 0
+        # url -> Future for the image, while it's being loaded
+        self.loading = {}
+        # url -> when it last failed to load
+        self.failed = {}
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.downloads = 0
+        self.failures = 0
+
+        if cache_dir is not None:
+            self._scan_disk()
+
+    def _scan_disk(self):
+        objects_dir = os.path.join(self.cache_dir, "objects")
+        if not os.path.isdir(objects_dir):
+            return
+        entries = []
+        for name in os.listdir(objects_dir):
+            path = os.path.join(objects_dir, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.objects[name] = size
+            self.disk_bytes += size
+
+    # Returns the image at url as a PIL image, or None if it couldn't be
+    # downloaded or decoded. Images are shared between callers, so copy them
+    # before changing them in place.
+    def get_image(self, url):
+        with self.lock:
+            if url in self.memory:
+                self.memory.move_to_end(url)
+                self.memory_hits += 1
+                metrics.count("images.cache_memory_hits")
+                return self.memory[url][0]
+            if time.time() - self.failed.get(url, -self.failure_ttl) < self.failure_ttl:
+                return None
+            future = self.loading.get(url)
+            loader = future is None
+            if loader:
+                future = self.loading[url] = Future()
+        if not loader:
+            return future.result()
+
+        img = None
+        try:
+            img = self._load(url)
+        finally:
+            with self.lock:
+                if img is not None:
+                    self._remember(url, img)
+                    self.failed.pop(url, None)
+                else:
+                    self.failed[url] = time.time()
+                del self.loading[url]
+            future.set_result(img)
+        return img
+
+    def _load(self, url):
+        data = self._disk_get(url)
+        downloaded = data is None
+        if downloaded:
+            try:
+                data = self.fetch(url)
+            except (urllib.error.URLError, OSError) as e:
+                print("Error:", e)
+                with self.lock:
+                    self.failures += 1
+                metrics.count("images.load_failures")
+                return None
+        # Decode here, in whichever thread is loading, so using it later is free
+        try:
+            with metrics.timer("images.decode"):
+                img = Image.open(BytesIO(data))
+                if self.draft_size is not None:
+                    img.draft(img.mode, self.draft_size)
+                img.load()
+        except (OSError, Image.DecompressionBombError) as e:
+            print("Error:", e)
+            with self.lock:
+                self.failures += 1
+            metrics.count("images.load_failures")
+            return None
+        with self.lock:
+            if downloaded:
+                self.downloads += 1
+            else:
+                self.disk_hits += 1
+        metrics.count("images.downloads" if downloaded else "images.cache_disk_hits")
+        if downloaded and self.cache_dir is not None:
+            self._disk_put(url, data)
+        return img
+
+    def _remember(self, url, img):
+        size = img.size[0] * img.size[1] * len(img.getbands())
+        if size > self.max_memory_bytes:
+            return
+        self.memory[url] = (img, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted
+
+    def _disk_get(self, url):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, "urls", _digest(url))) as f:
+                digest = f.read().strip()
+            path = os.path.join(self.cache_dir, "objects", digest)
+            with open(path, "rb") as f:
+                data = f.read()
+            # Keep the eviction order right across restarts
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if digest in self.objects:
+                self.objects.move_to_end(digest)
+        return data
+
+    def _disk_put(self, url, data):
+        digest = hashlib.sha256(data).hexdigest()
+        _write_file(os.path.join(self.cache_dir, "objects", digest), data)
+        _write_file(os.path.join(self.cache_dir, "urls", _digest(url)), digest.encode())
+        with self.lock:
+            if digest not in self.objects:
+                self.objects[digest] = len(data)
+                self.disk_bytes += len(data)
+            self.objects.move_to_end(digest)
+            evicted = []
+            while self.disk_bytes > self.max_disk_bytes and len(self.objects) > 1:
+                name, size = self.objects.popitem(last=False)
+                self.disk_bytes -= size
+                evicted.append(name)
+        # Urls pointing at evicted objects just miss and get downloaded again
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.cache_dir, "objects", name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "memory_images": len(self.memory),
+                "memory_bytes": self.memory_bytes,
+                "disk_images": len(self.objects),
+                "disk_bytes": self.disk_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "downloads": self.downloads,
+                "failures": self.failures,
+            }
+
+# Caches the results of search(query) by query, in memory and (with
+# cache_dir) as searches/<sha256 of the query>.json on disk, for ttl seconds.
+# Queries differing only in case and spacing share results. Empty results
+# aren't cached, since they usually mean the search itself broke.
+class SearchCache:
+    def __init__(self, search, cache_dir=None, ttl=SEARCH_TTL, max_entries=256):
+        self.search = search
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # query -> (time searched, results), least recently used first
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query):
+        key = " ".join(query.lower().split())
+        with self.lock:
+            entry = self.memory.get(key)
+        if entry is None:
+            entry = self._disk_get(key)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            with self.lock:
+                self.hits += 1
+                self._remember(key, entry)
+            metrics.count("images.search_cache_hits")
+            return entry[1]
+
+        with metrics.timer("images.search"):
+            results = self.search(query)
+        with self.lock:
+            self.misses += 1
+            if results:
+                self._remember(key, (time.time(), results))
+        if results and self.cache_dir is not None:
+            _write_file(os.path.join(self.cache_dir, "searches", _digest(key) + ".json"),
+                json.dumps({"query": key, "time": time.time(), "results": results}).encode())
+        return results
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, "searches", _digest(key) + ".json")) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        # Lists of lists come back from json, but results are tuples
+        return entry["time"], [tuple(result) for result in entry["results"]]
+
+    def stats(self):
+        with self.lock:
+            return {"queries": len(self.memory), "hits": self.hits, "misses": self.misses}
+
+# Downloads and decodes images into an ImageCache on a pool of threads, ahead
+# of when they're needed or several at once.
+class Prefetcher:
+    def __init__(self, cache, workers=8):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Starts loading all of urls. Returns a Future for each image.
+    def prefetch(self, urls):
+        return [self.executor.submit(self.cache.get_image, url) for url in urls]
+
+    # Loads all of urls at once and returns the url and image of the first to
+    # come in usable, or (None, None) if none do within timeout seconds. The
+    # rest still end up cached.
+    def first_image(self, urls, timeout=None):
+        futures = dict(zip(self.prefetch(urls), urls))
+        try:
+            for future in as_completed(futures, timeout):
+                if future.result() is not None:
+                    return futures[future], future.result()
+        except TimeoutError:
+            pass
+        return None, None
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        cache = ImageCache(sys.argv[1])
+        with Prefetcher(cache) as prefetcher:
+            start = time.perf_counter()
+            images = [future.result() for future in prefetcher.prefetch(sys.argv[2:])]
+        for url, img in zip(sys.argv[2:], images):
+            print("{}: {}".format(url, "{}x{} {}".format(*img.size, img.mode) if img else "failed"))
+        print("Loaded in {:.2f} s, {}".format(time.perf_counter() - start, cache.stats()))
+    else:
+        err_msg()
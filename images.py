@@ -1,24 +1,164 @@
 from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import json
+import os
+import re
 import textwrap
-import urllib.request as request
-import urllib.error
+
+import metrics
+from image_cache import ImageCache, Prefetcher, SearchCache, fetch
 
 IMAGE_SIZE = (500, 500)
+FONT_FILE = "font/FreeSans.ttf"
+# Pixels between lines of text, as in ImageDraw.multiline_text
+LINE_SPACING = 4
+CACHE_DIR = "data/cache"
+# Downscaling by more than this factor starts with a fast integer reduce()
+REDUCING_GAP = 3.0
+# Save options for each output format, which callers can override. PNG
+# compression past level 3 costs a lot of time for next to no size on memes.
+SAVE_OPTIONS = {
+    "PNG": {"compress_level": 3},
+    "WEBP": {"quality": 80, "method": 4},
+    "JPEG": {"quality": 85, "optimize": True},
+}
 WATERMARK = Image.open("img/watermark.png")
 # Mismatching widths between image size and watermark will stretch the watermark
 if WATERMARK.size[0] != IMAGE_SIZE[0]:
     WATERMARK = WATERMARK.resize((IMAGE_SIZE[0], WATERMARK.size[1]), Image.BICUBIC)
+# The watermark already pasted onto white, for the bottom of text memes
+WATERMARK_STRIP = Image.new("RGB", WATERMARK.size, "white")
+WATERMARK_STRIP.paste(WATERMARK, (0, 0), mask=WATERMARK)
 
-# Gets a list of image url, image type tuples using the search query.
-def get_google_images(query):
+# Returns the font at the given size. Fonts are loaded once and kept around.
+@lru_cache(maxsize=32)
+def get_font(size):
+    metrics.count("images.font_loads")
+    return ImageFont.truetype(FONT_FILE, size)
+
+# Advance widths and rendered bitmaps of the glyphs of the font at one size,
+# filled in as characters come up. Text laid out with the advances and drawn
+# glyph by glyph comes out the same as with ImageDraw, which measures and
+# renders every string from scratch.
+class GlyphCache:
+    def __init__(self, size):
+        self.font = get_font(size)
+        self.advances = {}
+        # How far each glyph's ink reaches left of where it's drawn and right
+        # of its advance
+        self.overhangs = {}
+        # (bitmap, offset) of each glyph, or None for blank ones like spaces
+        self.glyphs = {}
+        # Height of a line of text plus the spacing below it, measured the
+        # same way as multiline text in ImageDraw
+        self.line_height = self.font.getbbox("A")[3] + LINE_SPACING
+
+    # Returns the width of a line of text in pixels, measured like
+    # ImageDraw.textsize: the advances, plus any ink of the first glyph left of
+    # the start and of the last glyph past its advance.
+    def width(self, line):
+        if not line:
+            return 0
+        advances = self.advances
+        try:
+            width = sum(map(advances.__getitem__, line))
+        except KeyError:
+            for char in set(line) - advances.keys():
+                advances[char] = advance = self.font.getlength(char)
+                x0, _, x1, _ = self.font.getbbox(char)
+                self.overhangs[char] = (max(0, -x0), max(0, x1 - advance))
+            width = sum(map(advances.__getitem__, line))
+        return width + self.overhangs[line[0]][0] + self.overhangs[line[-1]][1]
+
+    # Returns the bitmap of a character and its offset from where it's drawn.
+    def glyph(self, char):
+        if char not in self.glyphs:
+            metrics.count("images.glyph_renders")
+            x0, y0, x1, y1 = self.font.getbbox(char)
+            if x1 > x0 and y1 > y0:
+                bitmap = Image.new("L", (x1 - x0, y1 - y0))
+                ImageDraw.Draw(bitmap).text((-x0, -y0), char, fill=255, font=self.font)
+                self.glyphs[char] = (bitmap, (x0, y0))
+            else:
+                self.glyphs[char] = None
+        return self.glyphs[char]
+
+@lru_cache(maxsize=32)
+def get_glyph_cache(size):
+    return GlyphCache(size)
+
+# Returns the width and height of lines of text in the font at the given size.
+def text_size(lines, size):
+    glyphs = get_glyph_cache(size)
+    width = max(map(glyphs.width, lines), default=0)
+    return width, len(lines) * glyphs.line_height - LINE_SPACING
+
+# Wraps text at the most characters per line (from min_chars to max_chars)
+# that keep it within max_width pixels in the font at the given size, trying
+# each from max_chars down. If no width fits, it's wrapped at min_chars anyway.
+def wrap_to_width(text, size, max_width, min_chars=2, max_chars=60):
+    glyphs = get_glyph_cache(size)
+    # Longest run of word or space characters, which textwrap never joins
+    longest_run = max(map(len, re.split(r"([\t\n\x0b\x0c\r ]+)", text.expandtabs())))
+    chars = max_chars
+    while chars >= min_chars:
+        lines = textwrap.wrap(text, width=chars)
+        metrics.count("images.layout_iterations")
+        if max(map(glyphs.width, lines), default=0) <= max_width:
+            return lines
+        # When nothing had to be split, every width down to the longest line
+        # wraps the same way, so none of those fit either
+        longest_line = max(map(len, lines), default=0)
+        if longest_run <= longest_line:
+            chars = min(chars, longest_line)
+        chars -= 1
+    return textwrap.wrap(text, width=min_chars)
+
+# Draws lines of text in the font at the given size with draw, like
+# draw.multiline_text, from cached glyphs. Each line's glyphs are put together
+# into one mask first, taking the darker of any pixels where neighbouring
+# glyphs overlap, just as Pillow renders a line.
+def draw_lines(draw, xy, lines, size, fill):
+    glyphs = get_glyph_cache(size)
+    x0, y = xy
+    for line in lines:
+        # Makes sure the advances of all the characters are cached
+        glyphs.width(line)
+        placed = []
+        x = 0
+        for char in line:
+            glyph = glyphs.glyph(char)
+            if glyph is not None:
+                bitmap, (dx, dy) = glyph
+                placed.append((x + dx, dy, bitmap))
+            x += glyphs.advances[char]
+        if placed:
+            left = min(gx for gx, _, _ in placed)
+            top = min(gy for _, gy, _ in placed)
+            right = max(gx + bitmap.size[0] for gx, _, bitmap in placed)
+            bottom = max(gy + bitmap.size[1] for _, gy, bitmap in placed)
+            mask = Image.new("L", (int(right - left), bottom - top))
+            # Right edge of the glyphs so far
+            inked = left
+            for gx, gy, bitmap in placed:
+                box = (int(gx - left), gy - top, int(gx - left) + bitmap.size[0], gy - top + bitmap.size[1])
+                if gx < inked:
+                    bitmap = ImageChops.lighter(mask.crop(box), bitmap)
+                mask.paste(bitmap, box)
+                inked = max(inked, gx + bitmap.size[0])
+            draw.bitmap((x0 + left, y + top), mask, fill=fill)
+        y += glyphs.line_height
+
+# Scrapes a list of image url, image type tuples from a Google image search
+# for query.
+def search_google_images(query):
     query = query.replace(' ', '+')
     url = "https://www.google.com/search?q=" + query + "&source=lnms&tbm=isch"
     headers = {"User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/43.0.2357.134 Safari/537.36"}
-    content = request.urlopen(request.Request(url, headers=headers))
-    soup = BeautifulSoup(content, "html5lib")
+    soup = BeautifulSoup(fetch(url, headers), "html5lib")
     imgs = []
     for div in soup.find_all("div", {"class": "rg_meta"}):
         metadata = json.loads(div.text)
@@ -26,52 +166,68 @@ def get_google_images(query):
         imgs.append((imgurl, typ))
     return imgs
 
-# Gets a PIL image from the url.
+# Images only ever get scaled to IMAGE_SIZE[0] wide, so JPEGs can be decoded
+# at a fraction of their size if they're much bigger than that
+IMAGE_CACHE = ImageCache(os.path.join(CACHE_DIR, "images"), draft_size=(IMAGE_SIZE[0], 1))
+SEARCH_CACHE = SearchCache(search_google_images, os.path.join(CACHE_DIR, "searches"))
+PREFETCHER = Prefetcher(IMAGE_CACHE)
+
+# Gets a list of image url, image type tuples using the search query.
+def get_google_images(query):
+    return SEARCH_CACHE.get(query)
+
+# Gets a PIL image from the url, or None if it can't be loaded. The image is
+# cached and shared, so it shouldn't be changed in place.
 def get_image_from_url(url):
-    try:
-        content = request.urlopen(url).read()
-    except (urllib.error.HTTPError, urllib.error.URLError) as e:
-        print(e)
-        return None
-    else:
-        f = BytesIO(content)
-        img = Image.open(f).copy()
-        f.close()
-        return img
+    return IMAGE_CACHE.get_image(url)
+
+# Loads the images at urls concurrently and returns the url and image of the
+# first usable one, or (None, None). The others are cached for later.
+def get_first_image(urls, timeout=None):
+    return PREFETCHER.first_image(urls, timeout)
 
 def resize_width_keep_aspect(img, width_new):
     width, height = img.size
     height_new = width_new * height // width
-    return img.resize((width_new, height_new), Image.BICUBIC)
+    return img.resize((width_new, height_new), Image.BICUBIC, reducing_gap=REDUCING_GAP)
+
+# Returns a blank text meme canvas of the given height, white with the
+# watermark along the bottom. It's shared, so copy it before drawing on it.
+@lru_cache(maxsize=16)
+def get_text_meme_canvas(height):
+    canvas = Image.new("RGB", (IMAGE_SIZE[0], height), "white")
+    canvas.paste(WATERMARK_STRIP, (0, height-WATERMARK.size[1]))
+    return canvas
 
 # Creates a text meme using text.
+@metrics.timed("images.render_text_meme")
 def create_text_meme(text):
-    ret_img = Image.new("RGBA", IMAGE_SIZE)
-
     # Prepare drawing the text
-    freesans = ImageFont.truetype("font/FreeSans.ttf", 24)
-    draw = ImageDraw.Draw(ret_img)
-    for char_width in range(60, 1, -1):
-        new_text = '\n'.join(textwrap.wrap(text, width=char_width))
-        width, height = draw.multiline_textsize(new_text, freesans)
-        if width <= IMAGE_SIZE[0]-20:
-            break
-    del draw
+    lines = wrap_to_width(text, 24, IMAGE_SIZE[0]-20, 2, 60)
+    width, height = text_size(lines, 24)
+
+    # Size the image based on the text size
+    img_height = max(IMAGE_SIZE[1],height)+20+WATERMARK.size[1]
+    top = img_height//2 - height//2
+    # The watermark goes over any text that runs into it, so only start off
+    # with it when the text stays clear
+    glyphs = get_glyph_cache(24)
+    text_bottom = top + (len(lines)-1)*glyphs.line_height + sum(glyphs.font.getmetrics())
+    watermarked = text_bottom <= img_height-WATERMARK.size[1]
+    if watermarked:
+        ret_img = get_text_meme_canvas(img_height).copy()
+    else:
+        ret_img = Image.new("RGB", (IMAGE_SIZE[0], img_height), "white")
 
-    # Resize the image based on the text size and then draw it
-    ret_img = ret_img.resize((IMAGE_SIZE[0],
-        max(IMAGE_SIZE[1],height)+20+WATERMARK.size[1]))
-    # Fill with white before drawing text
-    ret_img.paste("white", (0, 0, ret_img.size[0], ret_img.size[1]))
     # Then draw the text
     draw = ImageDraw.Draw(ret_img)
-    draw.multiline_text((10,ret_img.size[1]//2 - height//2),
-        new_text, fill="black", font=freesans)
+    draw_lines(draw, (10,top), lines, 24, "black")
     del draw
 
     # Finally, paste the watermark
-    ret_img.paste(WATERMARK, (0, ret_img.size[1]-WATERMARK.size[1]),
-        mask=WATERMARK)
+    if not watermarked:
+        ret_img.paste(WATERMARK, (0, ret_img.size[1]-WATERMARK.size[1]),
+            mask=WATERMARK)
 
     return ret_img
 
@@ -80,11 +236,14 @@ def create_text_with_image_meme(text, imgurl):
     inside_img = get_image_from_url(imgurl)
     if not inside_img:
         return None
-    
-    ret_img = Image.new("RGBA", IMAGE_SIZE)
-    
+    return render_text_with_image_meme(text, inside_img)
+
+# Creates a Twitter-like text+image meme using text and the PIL image
+# inside_img.
+@metrics.timed("images.render_text_with_image_meme")
+def render_text_with_image_meme(text, inside_img):
     # First, fill with white
-    ret_img.paste("white", (0, 0, IMAGE_SIZE[0], IMAGE_SIZE[1]))
+    ret_img = Image.new("RGBA", IMAGE_SIZE, "white")
 
     # Draw the text
     draw = ImageDraw.Draw(ret_img)
@@ -92,13 +251,13 @@ def create_text_with_image_meme(text, imgurl):
     # Increment the amt of characters per line quadratically from 48-104 chars
     char_widths = (48 + int(4*(x*x - x)/15) for x in range(16))
     for font_size, char_width in zip(font_sizes, char_widths):
-        new_text = '\n'.join(textwrap.wrap(text, width=char_width))
-        freesans = ImageFont.truetype("font/FreeSans.ttf", font_size)
-        width, height = draw.multiline_textsize(new_text, freesans)
+        lines = textwrap.wrap(text, width=char_width)
+        metrics.count("images.layout_iterations")
+        width, height = text_size(lines, font_size)
         if width <= IMAGE_SIZE[0]-20 and height <= IMAGE_SIZE[1]//3-20:
             break
     inside_img_top = height + 20
-    draw.multiline_text((10,10), new_text, fill="black", font=freesans)
+    draw_lines(draw, (10,10), lines, font_size, "black")
     del draw
 
     # Paste the related image
@@ -118,4 +277,54 @@ def create_text_with_image_meme(text, imgurl):
     ret_img.paste(WATERMARK, (0, ret_img.size[1]-WATERMARK.size[1]),
         mask=WATERMARK)
 
-    return ret_img
\ No newline at end of file
+    return ret_img
+
+# Encodes img as format (PNG, WEBP or JPEG), with SAVE_OPTIONS for the format
+# updated with options. Returns the encoded data.
+@metrics.timed("images.encode")
+def encode_image(img, format="PNG", **options):
+    format = format.upper()
+    if format == "JPEG" and img.mode != "RGB":
+        img = img.convert("RGB")
+    f = BytesIO()
+    img.save(f, format, **dict(SAVE_OPTIONS.get(format, {}), **options))
+    metrics.count("images.encoded_bytes", f.tell())
+    return f.getvalue()
+
+def _render_memes(jobs, format, options):
+    memes = []
+    for text, img in jobs:
+        if img is None:
+            meme = create_text_meme(text)
+        elif isinstance(img, str):
+            meme = create_text_with_image_meme(text, img)
+        else:
+            meme = render_text_with_image_meme(text, img)
+        memes.append(encode_image(meme, format, **options) if meme else None)
+    return memes
+
+# Renders a meme of each of texts and encodes it with encode_image. imgs, if
+# given, has an image url or PIL image for each text to make a text+image
+# meme with, or None for a text meme. Returns the encoded memes in order, with
+# None for any whose image couldn't be loaded.
+#
+# With processes other than 1, the memes are spread over a pool of that many
+# processes (all CPUs for None). Images at urls are loaded before the workers
+# fork, so they all get them from the cache.
+@metrics.timed("images.render_memes")
+def render_memes(texts, imgs=None, format="PNG", processes=1, **options):
+    imgs = list(imgs) if imgs is not None else [None] * len(texts)
+    assert len(imgs) == len(texts)
+    for future in PREFETCHER.prefetch({img for img in imgs if isinstance(img, str)}):
+        future.result()
+    jobs = list(zip(texts, imgs))
+
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(jobs) <= 1:
+        return _render_memes(jobs, format, options)
+    # Split the batch into a few chunks per process, in order
+    chunksize = max(1, -(-len(jobs) // (processes * 4)))
+    with ProcessPoolExecutor(processes) as executor:
+        chunks = executor.map(partial(_render_memes, format=format, options=options),
+            [jobs[i:i+chunksize] for i in range(0, len(jobs), chunksize)])
+        return [meme for chunk in chunks for meme in chunk]
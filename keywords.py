@@ -0,0 +1,61 @@
+from collections import Counter
+import heapq
+import math
+import re
+
+KEYWORD_REGEX = re.compile(r"[A-Za-z'\*\-]+")
+# Shorter words are almost never what a text is about
+MIN_KEYWORD_LENGTH = 3
+# Words in fewer documents than this are mostly typos and one-off names, so
+# they're weighted as if they were in this many, no higher than the rarest
+# real words
+MIN_DOC_FREQ = 3
+# The most common words in English, which say nothing about what a text is
+# about
+with open("data/mostcommonwords.txt") as f:
+    STOPWORDS = frozenset(l.strip().lower() for l in f)
+
+# Returns the lowercased words of text that could be keywords, in order, with
+# any leading or trailing hyphens and apostrophes (and possessive 's) taken
+# off. Stopwords, short words and censored words are left out.
+def keyword_words(text):
+    words = []
+    for word in KEYWORD_REGEX.findall(text.lower()):
+        word = word.strip("-'")
+        if word.endswith("'s"):
+            word = word[:-2]
+        if len(word) >= MIN_KEYWORD_LENGTH and word not in STOPWORDS and '*' not in word:
+            words.append(word)
+    return words
+
+# Picks out the words that best describe a text by TF-IDF: how often each
+# appears in the text, weighted by how rare it is in the documents the model
+# was trained on. doc_freqs maps words to the number of documents (out of
+# documents) they appear in; without them, words are just ranked by count.
+# Weights are smoothed as in scikit-learn, log((1 + documents) / (1 + df)) + 1.
+class KeywordExtractor:
+    def __init__(self, doc_freqs=None, documents=0):
+        self.doc_freqs = doc_freqs or {}
+        self.documents = documents
+        self._idfs = {}
+
+    def idf(self, word):
+        idf = self._idfs.get(word)
+        if idf is None:
+            if not self.documents:
+                # Nothing to go on, so words are ranked by count
+                idf = 1
+            else:
+                df = max(self.doc_freqs.get(word, 0), MIN_DOC_FREQ)
+                idf = math.log((1 + self.documents) / (1 + df)) + 1
+            self._idfs[word] = idf
+        return idf
+
+    # Returns the n best keywords of text, best first. Ties go to the word
+    # that comes first.
+    def keywords(self, text, n):
+        counts = Counter(keyword_words(text))
+        return heapq.nlargest(n, counts, key=lambda word: counts[word] * self.idf(word))
+
+    def keywords_batch(self, texts, n):
+        return [self.keywords(text, n) for text in texts]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+from urllib.parse import urlsplit
+import asyncio
+import statistics
+import sys
+import time
+
+def err_msg():
+    print("Usage: {} <url> [requests] [concurrency]: load test a running server.py, e.g. http://127.0.0.1:8080/copypasta".format(sys.argv[0]))
+
+# Sends GET requests for path over one keep-alive connection until there are
+# no requests left, appending the latency of each to latencies and counting
+# the status codes in statuses.
+async def client(host, port, path, remaining, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    request = "GET {} HTTP/1.1\r\nHost: {}:{}\r\n\r\n".format(path, host, port).encode("latin-1")
+    try:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length, close = 0, False
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+                elif name.strip().lower() == "connection":
+                    close = value.strip().lower() == "close"
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            if close:
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+    finally:
+        writer.close()
+
+async def load_test(url, requests, concurrency):
+    url = urlsplit(url)
+    path = url.path + ("?" + url.query if url.query else "")
+    remaining, latencies, statuses = [requests], [], {}
+    start = time.perf_counter()
+    await asyncio.gather(*(client(url.hostname, url.port or 80, path, remaining, latencies, statuses)
+        for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    print("{} requests to {} with {} connections in {:.2f} s".format(len(latencies), url.geturl(), concurrency, elapsed))
+    print("  requests/sec: {:10.1f}".format(len(latencies) / elapsed))
+    if len(latencies) >= 2:
+        quantiles = statistics.quantiles(latencies, n=100)
+        print("  p50:          {:10.1f} ms".format(quantiles[49] * 1000))
+        print("  p99:          {:10.1f} ms".format(quantiles[98] * 1000))
+    print("  statuses:     {}".format(", ".join("{}: {}".format(status, n) for status, n in sorted(statuses.items()))))
+
+if __name__ == "__main__":
+    if 2 <= len(sys.argv) <= 4:
+        requests = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+        concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 32
+        asyncio.run(load_test(sys.argv[1], requests, concurrency))
+    else:
+        err_msg()
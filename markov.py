@@ -1,18 +1,141 @@
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+import os
 import random
 import re
 import sqlite3
+import threading
 
 import censorer
+import metrics
+from keywords import KeywordExtractor, keyword_words
+from markov_compiled import CompiledModel, MAX_SENTENCE_LENGTH, PUNCTUATION, SENTENCE_ENDS, context_key, context_keys
 
 EXTRA_PUNCT_REGEX = re.compile(r"[\/#$%\^{}=_`~()\"]")
 WORD_REGEX = re.compile(r"([A-Za-z0-9\-\']+|[.,!?&;:])")
+# Run on every new connection. WAL lets generators keep reading while a
+# trainer writes, and the rest trades durability for speed, which is fine for
+# a model that can be retrained.
+SQLITE_PRAGMAS = [
+    "pragma journal_mode=wal;",
+    "pragma synchronous=normal;",
+    "pragma cache_size=-65536;", # 64 MiB
+    "pragma mmap_size=268435456;", # 256 MiB
+    "pragma temp_store=memory;",
+]
+
+# Bumped whenever the tables change; see markov_migrate.py
+SCHEMA_VERSION = 3
+SCHEMA_TABLES = ["vocab", "settings", "edges", "states", "doc_freqs"]
+# Longest context a model can use
+MAX_ORDER = 5
+
+# Creates the model's tables using the cursor cur, if they don't exist yet.
+# Words are stored once in vocab and referred to by id everywhere else. The
+# edges out of contexts of every length up to the order of the model share
+# one table, keyed by hashes of their word ids (see
+# markov_compiled.context_keys). The states table holds the length, last word
+# and total instances of the edges out of every context, and settings holds
+# the order along with counters telling exported models apart. doc_freqs holds
+# the number of texts each keyword (see keywords.keyword_words) appears in,
+# out of the documents setting, for picking out keywords by TF-IDF.
+def create_tables(cur, order=2):
+    cur.execute("create table if not exists vocab (id integer primary key, word text not null unique);")
+    cur.execute("create table if not exists settings (name text primary key, value integer not null) without rowid;")
+    cur.execute("create table if not exists edges (context integer, nextid integer, instances integer not null, "
+        "primary key (context, nextid)) without rowid;")
+    cur.execute("create table if not exists states (context integer primary key, length integer not null, "
+        "currid integer not null, total integer not null);")
+    # For picking a random word that has outgoing edges
+    cur.execute("create index if not exists states_words on states (currid) where length=1;")
+    cur.execute("create table if not exists doc_freqs (word text primary key, documents integer not null) without rowid;")
+    cur.executemany("insert or ignore into settings (name, value) values (?, ?);",
+        (("order", order), ("writes", 0), ("instances", 0), ("documents", 0)))
+    cur.execute("pragma user_version = {};".format(SCHEMA_VERSION))
+
+# Returns True if the database behind the cursor cur has tables from before
+# the current schema version.
+def is_old_schema(cur):
+    if cur.execute("pragma user_version;").fetchone()[0] >= SCHEMA_VERSION:
+        return False
+    cur.execute("select name from sqlite_master where type='table' and name='edges_first';")
+    return len(cur.fetchall()) > 0
+
+# Splits text into the words (and punctuation marks) used as Markov states.
+# Every text is treated as if it follows the end of a sentence.
+def tokenize(text):
+    # Remove unnecessary punctuation
+    text = EXTRA_PUNCT_REGEX.sub("", text)
+    if text == "":
+        return []
+    return WORD_REGEX.findall(". " + text)
+
+# Returns empty counts (see count_edges) for a model of the given order.
+def empty_counts(order=2):
+    return [Counter() for _ in range(order + 1)]
+
+# Tallies the edges out of contexts of up to order words over an iterable of
+# texts. Returns a list of Counters, one per context length, keyed by the
+# words of the context followed by the next word: (currword, nextword),
+# (prevword, currword, nextword) and so on. A last Counter holds the number of
+# texts each keyword appears in, and the number of texts under None.
+@metrics.timed("markov.count_edges")
+def count_edges(texts, order=2):
+    counts = empty_counts(order)
+    doc_freqs = counts[-1]
+    for text in texts:
+        words = tokenize(text)
+        for length, edge_counts in enumerate(counts[:order], 1):
+            edge_counts.update(zip(*(words[i:] for i in range(length + 1))))
+        doc_freqs.update(set(keyword_words(text)))
+        doc_freqs[None] += 1
+    return counts
+
+# Adds the edge counts of one shard (as returned by count_edges) into another.
+# Merging is associative, so shards can be counted and merged in any order.
+def merge_counts(counts, shard_counts):
+    for edge_counts, shard_edge_counts in zip(counts, shard_counts):
+        edge_counts.update(shard_edge_counts)
+    return counts
+
+# Splits an iterable into lists of up to size items, reading it lazily.
+def chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+# The model used by generate_batch worker processes
+_batch_model = None
+
+def _init_batch_worker(model):
+    global _batch_model
+    _batch_model = model
+
+# Generates paragraphs start, start+1, ... of a batch, one per minimum word
+# count in wordmins. model defaults to the one given to this worker process.
+def _generate_paragraphs(model, seed, start, wordmins):
+    model = model or _batch_model
+    return [model.get_random_paragraph_min(wordmin, rng=random.Random("{}:{}".format(seed, start + i)))
+        for i, wordmin in enumerate(wordmins)]
 
 class MarkovModel:
-    def __init__(self, sqldb_filename, fallback_probability=0.2, beginning_word_probability=0.8, censor=True):
+    def __init__(self, sqldb_filename, fallback_probability=0.2, beginning_word_probability=0.8, censor=True, compiled=False, bake_censor=False, flush_interval=None, model_filename=None, order=None):
         self.sqldb = sqldb_filename
-        # fallback_pr is the probability of using the first-order model instead
-        # of the second-order. This is partially to prevent infinite loops as
-        # well as ensure some degree of randomness.
+        # order is the number of words the next word depends on, from 1 to
+        # MAX_ORDER. It's fixed when the database is created (2 if not given);
+        # an existing database keeps the order it was created with.
+        if order is not None and not 1 <= order <= MAX_ORDER:
+            raise ValueError("order must be between 1 and {}".format(MAX_ORDER))
+        self.order = order
+        # fallback_pr is the probability of backing off from a context to the
+        # next shorter one (down to just the current word). This is partially
+        # to prevent infinite loops as well as ensure some degree of
+        # randomness.
         self.fallback_pr = fallback_probability
         # begin_word_pr is the probability of a sentence beginning with a word
         # that starts off a sentence rather than one in the middle. This also
@@ -21,262 +144,561 @@ class MarkovModel:
         # censor set to True will censor words through the default word list.
         # Defaults to True because I don't wanna get zucced super easily.
         self.censor = censor
+        # compiled set to True will load the edge tables into memory the first
+        # time text is generated, and then generate text without querying the
+        # database at all.
+        self.compiled = compiled
+        self._compiled_model = None
+        # bake_censor set to True (along with compiled and censor) censors each
+        # word once when the model is compiled, rather than censoring every
+        # string that gets generated.
+        self.bake_censor = bake_censor
+        # model_filename is a binary model file written by export_model. If it
+        # exists and is up to date with the database, the compiled model is
+        # mapped from it instead of being loaded from the database.
+        self.model_filename = model_filename
+        # flush_interval set to a number of seconds writes the counts learned
+        # by learn_texts to the database in the background that often.
+        # Otherwise they're only written by flush (or close).
+        self.flush_interval = flush_interval
+        self._init_connections()
         self._make_table()
+        self._init_learning()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Connections can't be pickled (to send the model to a worker process), so
+    # the copy opens its own. It also leaves flushing the counts learned so far
+    # to the original.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("_local", "_connections", "_connections_lock", "_pid",
+                "_pending", "_pending_lock", "_flush_lock", "_flusher", "_stop_flushing"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_connections()
+        self._init_learning()
+
+    def _init_learning(self):
+        # Edge counts learned by learn_texts but not written to the database yet
+        self._pending = empty_counts(self.order)
+        self._pending_lock = threading.Lock()
+        # Held while pending counts are taken and written, and while the
+        # compiled model is loaded and has them added, so a load can't miss
+        # counts that were taken but not yet committed
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stop_flushing = threading.Event()
+
+    def _init_connections(self):
+        # Each thread gets its own connection, kept open until close()
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._pid = os.getpid()
+
+    # Returns this thread's connection to the database, opening it if needed.
+    def _connect(self):
+        # Connections inherited through a fork can't be used, so start over
+        # (and leave the learned counts to the parent)
+        if self._pid != os.getpid():
+            self._init_connections()
+            self._init_learning()
+        con = getattr(self._local, "con", None)
+        if con is None:
+            # Only this thread uses the connection, but close() may be called
+            # from any thread
+            con = sqlite3.connect(self.sqldb, check_same_thread=False)
+            for pragma in SQLITE_PRAGMAS:
+                con.execute(pragma)
+            if metrics.ENABLED:
+                con.set_trace_callback(lambda statement: metrics.count("markov.sql_queries"))
+            self._local.con = con
+            with self._connections_lock:
+                self._connections.append(con)
+        return con
+
+    # Flushes learned counts and closes every thread's connection to the
+    # database. The model can still be used afterwards; connections are
+    # reopened as needed.
+    def close(self):
+        if self._flusher is not None:
+            self._stop_flushing.set()
+            self._flusher.join()
+            self._flusher = None
+            self._stop_flushing.clear()
+        self.flush()
+        with self._connections_lock:
+            for con in self._connections:
+                con.close()
+            self._connections = []
+        self._local = threading.local()
 
     def _make_table(self):
-        con = sqlite3.connect(self.sqldb)
+        con = self._connect()
         try:
             cur = con.cursor()
 
-            # Determine if SQL table exists
-            cur.execute("select name from sqlite_master where type='table' and name='edges_first';")
-            # ...and then add if it doesn't
-            if len(cur.fetchall()) == 0:
-                cur.execute("create table edges_first (currword varchar, nextword varchar, instances int);")
-                con.commit()
-            
-            # Do the same for second-order edges
-            cur.execute("select name from sqlite_master where type='table' and name='edges_second';")
-            if len(cur.fetchall()) == 0:
-                cur.execute("create table edges_second (prevword varchar, currword varchar, nextword varchar, instances int);")
-                con.commit()
+            # Databases made with an older schema have to be upgraded with
+            # markov_migrate.py first
+            if is_old_schema(cur):
+                print("Error: {} uses an old schema, upgrade it with markov_migrate.py".format(self.sqldb))
+                return
+
+            create_tables(cur, self.order or 2)
+            order = cur.execute("select value from settings where name='order';").fetchone()[0]
+            if self.order and self.order != order:
+                print("Error: {} has order {}, using that instead of {}".format(self.sqldb, order, self.order))
+            self.order = order
+            con.commit()
 
         except sqlite3.OperationalError as e:
             print("Error:", e)
             con.rollback()
         finally:
-            con.close()
+            self.order = self.order or 2
 
     def add_text(self, text):
-        # Remove unnecessary punctuation
-        text = EXTRA_PUNCT_REGEX.sub("", text)
-        if text == "":
-            return
-        text = ". " + text
-
-        words = WORD_REGEX.findall(text)
-
-        con = sqlite3.connect(self.sqldb)
-
+        self.add_texts([text])
+
+    # Adds an iterable of texts to the model in bulk. Edge counts are tallied in
+    # memory first and then written out in a single transaction, so this is
+    # much faster than calling add_text on each line.
+    def add_texts(self, texts):
+        self._write_counts(count_edges(texts, self.order))
+        # The compiled model (if any) is stale now
+        self._compiled_model = None
+
+    # Like add_texts, but for corpora too big to read at once: texts are read
+    # lazily in chunks of chunk_size, counted in parallel over a pool of
+    # processes, and merged. Counts are written to the database whenever the
+    # merged tables grow past write_size edges, and at the end.
+    def train(self, texts, processes=None, chunk_size=10000, write_size=2000000):
+        processes = processes or os.cpu_count() or 1
+        counts = empty_counts(self.order)
+        def merge(shard_counts):
+            nonlocal counts
+            merge_counts(counts, shard_counts)
+            if sum(map(len, counts)) > write_size:
+                self._write_counts(counts)
+                counts = empty_counts(self.order)
+
+        if processes == 1:
+            for chunk in chunked(texts, chunk_size):
+                merge(count_edges(chunk, self.order))
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                # Only keep a couple of chunks per process in flight, so the
+                # corpus never has to fit in memory
+                futures = deque()
+                for chunk in chunked(texts, chunk_size):
+                    futures.append(pool.submit(count_edges, chunk, self.order))
+                    if len(futures) >= 2 * processes:
+                        merge(futures.popleft().result())
+                while futures:
+                    merge(futures.popleft().result())
+
+        if counts[0]:
+            self._write_counts(counts)
+        self._compiled_model = None
+
+    # Deletes the contexts longer than one word seen fewer than min_count
+    # times, along with their edges, to bound the size of higher-order models.
+    # Generation backs off to shorter contexts in their place.
+    def prune(self, min_count):
+        self.flush()
+        con = self._connect()
         try:
             cur = con.cursor()
-
-            for i in range(len(words) - 1):
-                prevword = words[i-1] if i > 0 else None
-                currword = words[i]
-                nextword = words[i+1]
-
-                print(currword, end=' ')
-
-                # Escape single quotes properly
-                if prevword: prevword = prevword.replace("'","''")
-                currword = currword.replace("'","''")
-                nextword = nextword.replace("'","''")
-
-                # Try to find this edge
-                cur.execute("select * from edges_first where currword='{}' and nextword='{}';".format(currword, nextword))
-
-                # If edge doesn't exist, add it
-                if len(cur.fetchall()) == 0:
-                    cur.execute("insert into edges_first (currword, nextword, instances) values ('{}', '{}', 1);".format(currword, nextword))
-                # Otherwise increment number of instances
-                else:
-                    cur.execute("update edges_first set instances = instances + 1 where currword='{}' and nextword='{}';".format(currword, nextword))
-                
-                # Do the same for second-order edges if prevword exists
-                if prevword:
-                    cur.execute("select * from edges_second where prevword='{}' and currword='{}' and nextword='{}';".format(prevword, currword, nextword))
-                    if len(cur.fetchall()) == 0:
-                        cur.execute("insert into edges_second (prevword, currword, nextword, instances) values ('{}', '{}', '{}', 1);".format(prevword, currword, nextword))
-                    else:
-                        cur.execute("update edges_second set instances = instances + 1 where prevword='{}' and currword='{}' and nextword='{}';".format(prevword, currword, nextword))
-
-                if i % 5000 == 4999: con.commit() # Commit every 5000 words
-
+            cur.execute("delete from edges where context in (select context from states where length > 1 and total < ?);", (min_count,))
+            cur.execute("delete from states where length > 1 and total < ?;", (min_count,))
+            cur.execute("update settings set value = value + 1 where name='writes';")
             con.commit()
-
         except sqlite3.OperationalError as e:
             print("Error:", e)
             con.rollback()
-        finally:
-            con.close()
-
-    def get_random_string(self, words=30, init_prevword=None):
-        con = sqlite3.connect(self.sqldb)
-
+        self._compiled_model = None
+
+    # Learns from new texts while the model is in use. Unlike add_texts, this
+    # doesn't throw away the compiled model: only the states the texts add
+    # edges to are updated in it. The edge counts are written to the database
+    # in one batch by the next flush.
+    def learn_texts(self, texts):
+        counts = count_edges(texts, self.order)
+        with self._pending_lock:
+            merge_counts(self._pending, counts)
+            if self._compiled_model is not None:
+                self._compiled_model.add_counts(counts)
+            if self.flush_interval and self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+                self._flusher.start()
+
+    def learn_text(self, text):
+        self.learn_texts([text])
+
+    # Writes the edge counts learned since the last flush to the database.
+    def flush(self):
+        with self._flush_lock:
+            with self._pending_lock:
+                counts = self._pending
+                self._pending = empty_counts(self.order)
+            if counts[0] and not self._write_counts(counts):
+                # Keep them around for the next try
+                with self._pending_lock:
+                    merge_counts(self._pending, counts)
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self.flush_interval):
+            self.flush()
+
+    # Returns the edge tables loaded into a CompiledModel, loading them if they
+    # haven't been already.
+    def get_compiled_model(self):
+        if self._compiled_model is None:
+            with self._flush_lock:
+                with metrics.timer("markov.load_model"):
+                    model = self._load_model_file()
+                    if model is None:
+                        model = CompiledModel.from_sqlite(self._connect(), self.fallback_pr, self.begin_word_pr)
+                    if self.censor and self.bake_censor:
+                        model.censor_words()
+                # Include whatever has been learned but not flushed yet
+                with self._pending_lock:
+                    if self._pending[0]:
+                        model.add_counts(self._pending)
+                    self._compiled_model = model
+        return self._compiled_model
+
+    # Returns the CompiledModel in model_filename, or None if there isn't one
+    # or it's out of date.
+    def _load_model_file(self):
+        if not self.model_filename or not os.path.exists(self.model_filename):
+            return None
+        try:
+            model = CompiledModel.load(self.model_filename, self.fallback_pr, self.begin_word_pr)
+        except (OSError, ValueError) as e:
+            print("Error:", e)
+            return None
+        if model.fingerprint != self._fingerprint():
+            print("{} is out of date, loading the model from {} instead".format(self.model_filename, self.sqldb))
+            return None
+        return model
+
+    # Returns a pair of ints that changes whenever edges are added or deleted.
+    def _fingerprint(self):
+        settings = dict(self._connect().execute("select name, value from settings;"))
+        return settings["writes"], settings["instances"]
+
+    # Writes the model to a binary file that can be given as model_filename.
+    def export_model(self, filename):
+        self.flush()
+        fingerprint = self._fingerprint()
+        model = CompiledModel.from_sqlite(self._connect(), self.fallback_pr, self.begin_word_pr)
+        model.save(filename, fingerprint)
+
+    # Returns a KeywordExtractor weighting words by how many of the texts the
+    # model was trained on they appear in. Models trained before document
+    # frequencies were kept just rank keywords by count.
+    def get_keyword_extractor(self):
+        self.flush()
+        con = self._connect()
+        try:
+            documents = con.execute("select value from settings where name='documents';").fetchone()[0]
+            doc_freqs = dict(con.execute("select word, documents from doc_freqs;"))
+        except sqlite3.OperationalError as e:
+            print("Error:", e)
+            return KeywordExtractor()
+        return KeywordExtractor(doc_freqs, documents)
+
+    # Writes edge counts (see count_edges) to the database, adding to the
+    # instances of edges (and totals of states) that already exist. Returns
+    # True if they were written.
+    @metrics.timed("markov.write_counts")
+    def _write_counts(self, counts):
+        con = self._connect()
         try:
             cur = con.cursor()
 
-            # Pick random word in words
-            prevword = init_prevword
-            currword = "."
-            while re.search(r"[.,!?;:]", currword): # Make sure it's not a punctuation mark
-                if random.random() < self.begin_word_pr:
-                    cur.execute("select distinct nextword from edges_first where currword='.' or currword='!' or currword='?';")
-                else:
-                    cur.execute("select distinct currword from edges_first;")
-                currword = random.choice(cur.fetchall())[0]
-
-            currstring = currword
-
-            while currword not in ".!?":
-                # If we have a previous word, try to find a connection from previous two words and get all possible next words
-                rows = []
-                if prevword and random.random() > self.fallback_pr:
-                    cur.execute("select nextword, cast(instances as float) / (select sum(instances) from edges_second where prevword='{}' and currword='{}') as probability from edges_second where prevword='{}' and currword='{}';".format(prevword.replace("'","''"), currword.replace("'","''"), prevword.replace("'","''"), currword.replace("'","''")))
-                    rows = cur.fetchall()
-                if not prevword or len(rows) == 0:
-                    # Otherwise get all possible next words from first-order connections
-                    cur.execute("select nextword, cast(instances as float) / (select sum(instances) from edges_first where currword='{}') as probability from edges_first where currword='{}';".format(currword.replace("'","''"), currword.replace("'","''")))
-                    rows = cur.fetchall()
-
-                # Get next word using probabilities
-                p = random.random()
-                if len(rows) > 0:
-                    for word, pr in rows:
-                        if p < pr:
-                            prevword = currword
-                            currword = word
-                            break
-                        p -= pr
-                else:
-                    # Select new random word since we don't have one
-                    cur.execute("select distinct currword from edges_first;")
-                    prevword = None
-                    currword = random.choice(cur.fetchall())[0]
-
-                if not re.search(r"[.,!?;:]", currword):
-                    currstring += " "
-
-                # Add next word to string
-                currstring += currword
-
-                # Break once we've arrived at the desired number of words
-                if len(currstring.split(" ")) == words:
-                    break
-            
-            if self.censor: currstring = censorer.censor(currstring)
+            # Every word shows up in a first-order edge, so this covers all of
+            # them. Sorted so word ids (and so seeded output) don't depend on
+            # the hash seed.
+            words = sorted(set(word for edge in counts[0] for word in edge))
+            cur.executemany("insert or ignore into vocab (word) values (?);", ((word,) for word in words))
+            word_ids = dict(cur.execute("select word, id from vocab;"))
+
+            edges, states = [], {}
+            for edge_counts in counts[:self.order]:
+                for edge, n in edge_counts.items():
+                    *context, nextid = (word_ids[word] for word in edge)
+                    key = context_key(context)
+                    edges.append((key, nextid, n))
+                    if key in states:
+                        states[key][3] += n
+                    else:
+                        states[key] = [key, len(context), context[-1], n]
+
+            cur.executemany(
+                "insert into edges (context, nextid, instances) values (?, ?, ?) "
+                "on conflict (context, nextid) do update set instances = instances + excluded.instances;",
+                edges
+            )
+            cur.executemany(
+                "insert into states (context, length, currid, total) values (?, ?, ?, ?) "
+                "on conflict (context) do update set total = total + excluded.total;",
+                states.values()
+            )
+            doc_freqs = counts[-1].copy()
+            documents = doc_freqs.pop(None, 0)
+            cur.executemany(
+                "insert into doc_freqs (word, documents) values (?, ?) "
+                "on conflict (word) do update set documents = documents + excluded.documents;",
+                doc_freqs.items()
+            )
+            cur.execute("update settings set value = value + 1 where name='writes';")
+            cur.execute("update settings set value = value + ? where name='instances';", (sum(counts[0].values()),))
+            cur.execute("update settings set value = value + ? where name='documents';", (documents,))
+            con.commit()
+            metrics.count("markov.edges_written", len(edges))
+            metrics.count("markov.documents_written", documents)
+            return True
 
         except sqlite3.OperationalError as e:
             print("Error:", e)
-            currstring = None
             con.rollback()
-        finally:
-            con.close()
-            return currstring
-
-    def get_random_string_min(self, wordmin=30, init_prevword=None):
-        con = sqlite3.connect(self.sqldb)
+            return False
+
+    # Generates an endless stream of sentences one token (word or punctuation
+    # mark) at a time, yielding (token, words) where words is the number of
+    # words generated so far. Tokens are censored one at a time, so censor
+    # words spanning several tokens (like "blow job") are only caught when the
+    # tokens are put together with join_tokens. censor set to False leaves
+    # tokens uncensored (unless the compiled model's words were censored when
+    # it was compiled), for callers that censor the joined string instead.
+    # capitalize set to True capitalizes the first word of every sentence.
+    def iter_tokens(self, init_prevword=None, capitalize=False, rng=random, censor=True):
+        if self.compiled:
+            tokens = self.get_compiled_model().iter_tokens(init_prevword, rng,
+                censored=self.censor and self.bake_censor)
+            censor_tokens = censor and self.censor and not self.bake_censor
+        else:
+            tokens = self._iter_sql_tokens(init_prevword, rng)
+            censor_tokens = censor and self.censor
+        # Decided once here rather than for every token
+        if metrics.ENABLED:
+            tokens = metrics.timed_iter("markov.sample", tokens)
+        censor_token = metrics.wrap_timed("censor.token", censorer.censor)
+
+        nwords = 0
+        sentence_start = True
+        for token in tokens:
+            if token not in PUNCTUATION:
+                nwords += 1
+            if censor_tokens:
+                token = censor_token(token, rng=rng)
+            if capitalize and sentence_start:
+                token = token[0:1].upper() + token[1:]
+            sentence_start = token in SENTENCE_ENDS
+            yield token, nwords
+
+    # Puts tokens from iter_tokens together into a string. Tokens from
+    # iter_tokens(censor=False) are passed with censored=False and censored
+    # here in a single pass over the whole string, which costs much less than
+    # censoring them one at a time. capitalize set to True then capitalizes
+    # the first word of every sentence, like iter_tokens does.
+    def join_tokens(self, tokens, rng=random, censored=True, capitalize=False):
+        parts = []
+        # Where each sentence starts in the string
+        starts = []
+        length = 0
+        sentence_start = True
+        for token in tokens:
+            if parts and token not in PUNCTUATION:
+                parts.append(" ")
+                length += 1
+            if capitalize and sentence_start:
+                starts.append(length)
+            sentence_start = token in SENTENCE_ENDS
+            parts.append(token)
+            length += len(token)
+        currstring = "".join(parts)
+        if self.censor:
+            spanning_only = censored or (self.compiled and self.bake_censor)
+            with metrics.timer("censor.spanning" if spanning_only else "censor.string"):
+                currstring = censorer.censor(currstring, rng=rng, spanning_only=spanning_only)
+        if starts:
+            # Censoring doesn't change the length of the string, so the
+            # sentences still start in the same places
+            chars = list(currstring)
+            for i in starts:
+                chars[i] = chars[i].upper()
+            currstring = "".join(chars)
+        return currstring
+
+    # Walks the model through the database, yielding the words of an endless
+    # stream of sentences. See iter_tokens and CompiledModel._next_id.
+    def _iter_sql_tokens(self, init_prevword=None, rng=random):
+        con = self._connect()
 
         try:
             cur = con.cursor()
 
-            # Pick random word in words
-            prevword = init_prevword
-            currword = "."
-            while re.search(r"[.,!?;:]", currword): # Make sure it's not a punctuation mark
-                if random.random() < self.begin_word_pr:
-                    cur.execute("select distinct nextword from edges_first where currword='.' or currword='!' or currword='?';")
-                else:
-                    cur.execute("select distinct currword from edges_first;")
-                currword = random.choice(cur.fetchall())[0]
-
-            currstring = currword
-
-            while currword not in ".!?":
-                # If we have a previous word, try to find a connection from previous two words and get all possible next words
+            # The last order word ids, most recent last
+            history = []
+            if init_prevword:
+                row = cur.execute("select id from vocab where word=?;", (init_prevword,)).fetchone()
+                history = [row[0]] if row else []
+            currid, currword = self._get_sql_start_word(cur, rng)
+            history.append(currid)
+            del history[:-self.order]
+            length = 0
+
+            while True:
+                yield currword
+
+                if currword in SENTENCE_ENDS:
+                    # Start another sentence, keeping the words before the end
+                    # of the last one as context
+                    history[-1], currword = self._get_sql_start_word(cur, rng)
+                    length = 0
+                    continue
+
+                # Cut off sentences that go on too long (see MAX_SENTENCE_LENGTH)
+                length += 1
+                if length >= MAX_SENTENCE_LENGTH:
+                    row = cur.execute("select id from vocab where word='.';").fetchone()
+                    if row:
+                        history.append(row[0])
+                        del history[:-self.order]
+                        currword = "."
+                        continue
+
+                # Try the longest context first, and back off to shorter ones
+                # if it hasn't been seen, down to just the current word
+                keys = context_keys(history)
                 rows = []
-                if prevword and random.random() > self.fallback_pr:
-                    cur.execute("select nextword, cast(instances as float) / (select sum(instances) from edges_second where prevword='{}' and currword='{}') as probability from edges_second where prevword='{}' and currword='{}';".format(prevword.replace("'","''"), currword.replace("'","''"), prevword.replace("'","''"), currword.replace("'","''")))
-                    rows = cur.fetchall()
-                if not prevword or len(rows) == 0:
-                    # Otherwise get all possible next words from first-order connections
-                    cur.execute("select nextword, cast(instances as float) / (select sum(instances) from edges_first where currword='{}') as probability from edges_first where currword='{}';".format(currword.replace("'","''"), currword.replace("'","''")))
+                for key in reversed(keys[1:]):
+                    if rng.random() > self.fallback_pr:
+                        cur.execute("select e.nextid, cast(e.instances as float) / s.total from edges e join states s on s.context = e.context where e.context=?;", (key,))
+                        rows = cur.fetchall()
+                        if len(rows) > 0:
+                            break
+                if len(rows) == 0:
+                    cur.execute("select e.nextid, cast(e.instances as float) / s.total from edges e join states s on s.context = e.context where e.context=?;", (keys[0],))
                     rows = cur.fetchall()
 
                 # Get next word using probabilities
-                p = random.random()
+                p = rng.random()
                 if len(rows) > 0:
-                    for word, pr in rows:
+                    for nextid, pr in rows:
                         if p < pr:
-                            prevword = currword
-                            currword = word
+                            history.append(nextid)
+                            if len(history) > self.order:
+                                del history[0]
                             break
                         p -= pr
                 else:
                     # Select new random word since we don't have one
-                    cur.execute("select distinct currword from edges_first;")
-                    prevword = None
-                    currword = random.choice(cur.fetchall())[0]
-
-                if not re.search(r"[.,!?;:]", currword):
-                    currstring += " "
-
-                # Add next word to string
-                currstring += currword
-
-                # Add another sentence if the description is really short
-                if len(currstring.split(" ")) < wordmin and re.search(r"[.!?]", currword):
-                    while re.search(r"[.,!?;:]", currword): # Make sure it's not a punctuation mark
-                        if random.random() < self.begin_word_pr:
-                            cur.execute("select distinct nextword from edges_first where currword='.' or currword='!' or currword='?';")
-                        else:
-                            cur.execute("select distinct currword from edges_first;")
-                        currword = random.choice(cur.fetchall())[0]
-                    currstring += " " + currword
-            
-            if self.censor: currstring = censorer.censor(currstring)
+                    cur.execute("select currid from states where length=1;")
+                    history = [rng.choice(cur.fetchall())[0]]
+                currword = cur.execute("select word from vocab where id=?;", (history[-1],)).fetchone()[0]
 
         except sqlite3.OperationalError as e:
             print("Error:", e)
-            currstring = None
             con.rollback()
-        finally:
-            con.close()
-            return currstring
-
-    def get_random_sentence(self, capitalize=True, init_prevword=None):
-        sentence = self.get_random_string_min(wordmin=1, init_prevword=init_prevword)
-        if capitalize: sentence = sentence[0:1].upper() + sentence[1:]
-        return sentence
-
-    def get_random_paragraph(self, sentences=5):
-        # Generates `sentences` sentences, puts them in a list, and then joins them with spaces.
-        paragraph = self.get_random_sentence()
-        for _ in range(sentences-1):
-            # Get last word of last sentence, without punctuation
-            init_prevword = paragraph.split(" ")[-1][:-1]
-            paragraph += " " + self.get_random_sentence(init_prevword=init_prevword)
-        return paragraph
-    
-    def get_random_paragraph_min(self, wordmin=30):
-        paragraph = self.get_random_sentence()
-        while len(paragraph.split()) < wordmin:
-            # Get last word of last sentence, without punctuation
-            init_prevword = paragraph.split(" ")[-1][:-1]
-            paragraph += " " + self.get_random_sentence(init_prevword=init_prevword)
-        return paragraph
+
+    # Picks a random word to start a sentence with using the cursor cur.
+    # Returns its id and the word itself.
+    def _get_sql_start_word(self, cur, rng=random):
+        currword = "."
+        while re.search(r"[.,!?;:]", currword): # Make sure it's not a punctuation mark
+            if rng.random() < self.begin_word_pr:
+                cur.execute("select id from vocab where word in ('.', '!', '?');")
+                ends = [context_key([endid]) for endid, in cur.fetchall()]
+                cur.execute("select distinct nextid from edges where context in ({});".format(", ".join("?" * len(ends))), ends)
+            else:
+                cur.execute("select currid from states where length=1;")
+            currid = rng.choice(cur.fetchall())[0]
+            currword = cur.execute("select word from vocab where id=?;", (currid,)).fetchone()[0]
+        return currid, currword
+
+    def get_random_string(self, words=30, init_prevword=None, rng=random):
+        tokens = []
+        for token, nwords in self.iter_tokens(init_prevword, rng=rng, censor=False):
+            tokens.append(token)
+            # Break at the end of the sentence or once we've arrived at the
+            # desired number of words
+            if token in SENTENCE_ENDS or (len(tokens) > 1 and nwords == words):
+                break
+        return self.join_tokens(tokens, rng, censored=False)
+
+    def get_random_string_min(self, wordmin=30, init_prevword=None, rng=random, capitalize=False):
+        tokens = []
+        for token, nwords in self.iter_tokens(init_prevword, rng=rng, censor=False):
+            tokens.append(token)
+            # Keep adding sentences until we have enough words
+            if token in SENTENCE_ENDS and nwords >= wordmin:
+                break
+        return self.join_tokens(tokens, rng, censored=False, capitalize=capitalize)
+
+    def get_random_sentence(self, capitalize=True, init_prevword=None, rng=random):
+        return self.get_random_string_min(wordmin=1, init_prevword=init_prevword, rng=rng, capitalize=capitalize)
+
+    def get_random_paragraph(self, sentences=5, rng=random):
+        tokens = []
+        for token, _ in self.iter_tokens(rng=rng, censor=False):
+            tokens.append(token)
+            if token in SENTENCE_ENDS:
+                sentences -= 1
+                if sentences <= 0:
+                    break
+        return self.join_tokens(tokens, rng, censored=False, capitalize=True)
+
+    def get_random_paragraph_min(self, wordmin=30, rng=random):
+        return self.get_random_string_min(wordmin, rng=rng, capitalize=True)
+
+    # Generates n paragraphs with get_random_paragraph_min, spread over a pool
+    # of processes that share this model. wordmin is either the same minimum
+    # for every paragraph or a list of n of them. Paragraph i is generated with
+    # its own RNG seeded from seed and i, so the output only depends on seed
+    # and not on the number of processes.
+    @metrics.timed("markov.generate_batch")
+    def generate_batch(self, n, wordmin=30, seed=None, processes=None):
+        wordmins = [wordmin] * n if isinstance(wordmin, int) else list(wordmin)
+        assert len(wordmins) == n
+        if seed is None:
+            seed = random.getrandbits(64)
+        if self.compiled:
+            # Load before forking so the workers inherit the compiled model
+            self.get_compiled_model()
+
+        processes = processes or os.cpu_count() or 1
+        if processes == 1 or n <= 1:
+            return _generate_paragraphs(self, seed, 0, wordmins)
+        # Split the batch into a few chunks per process, in order
+        chunksize = max(1, -(-n // (processes * 4)))
+        starts = range(0, n, chunksize)
+        with ProcessPoolExecutor(processes, initializer=_init_batch_worker, initargs=(self,)) as executor:
+            chunks = executor.map(partial(_generate_paragraphs, None, seed),
+                starts, [wordmins[i:i+chunksize] for i in starts])
+            return [paragraph for chunk in chunks for paragraph in chunk]
 
     def delete_table(self):
-        con = sqlite3.connect(self.sqldb)
+        self._compiled_model = None
+        con = self._connect()
         try:
             cur = con.cursor()
 
-            # Determine if SQL table exists
-            cur.execute("select name from sqlite_master where type='table' and name='edges_first';")
-            # ...and then delete if it does
-            if len(cur.fetchall()) > 0:
-                cur.execute("drop table edges_first;")
-                con.commit()
-            
-            # Same for second-order edges
-            cur.execute("select name from sqlite_master where type='table' and name='edges_second';")
-            if len(cur.fetchall()) > 0:
-                cur.execute("drop table edges_second;")
-                con.commit()
+            for table in SCHEMA_TABLES:
+                cur.execute("drop table if exists {};".format(table))
+            con.commit()
             
         except sqlite3.OperationalError as e:
             print("Error:", e)
             con.rollback()
-        finally:
-            con.close()
@@ -0,0 +1,407 @@
+from array import array
+from bisect import bisect_left
+import mmap
+import random
+import struct
+
+import censorer
+
+PUNCTUATION = ".,!?;:"
+SENTENCE_ENDS = ".!?"
+# Sentences are cut off with a period after this many tokens, so that a cycle
+# in the model with no way out (like "GIMME GIMME GIMME...") can't go on
+# forever. Sentences that long hardly ever come up otherwise.
+MAX_SENTENCE_LENGTH = 250
+
+# Binary model files (see CompiledModel.save) start with this header: magic,
+# format version, number of sections, order of the model and the fingerprint
+# of the database the model was exported from. Each section is a typecode and
+# a number of items followed by the items, padded to a multiple of 8 bytes.
+MODEL_MAGIC = b"MARKOVMD"
+MODEL_VERSION = 2
+MODEL_HEADER = struct.Struct("<8sIII4xqq")
+MODEL_SECTION = struct.Struct("<c7xq")
+TABLE_ARRAYS = ("keys", "offsets", "targets", "cumweights", "probs", "aliases")
+
+# Outgoing edges for every state (context) of the Markov model, stored
+# CSR-style: the edges of the state at row r are targets[offsets[r]:offsets[r+1]]
+# with running totals of their instances in cumweights. States are identified
+# by integer keys (see context_keys) kept sorted in keys, so a state is found
+# by binary search.
+# Each edge also has an entry in a Walker/Vose alias table (probs and aliases),
+# so picking the next word takes constant time however many edges a state has.
+# States whose edges changed since the table was built (see add_counts) are
+# kept in overrides instead, as (targets, weights, probs, aliases) lists.
+class TransitionTable:
+    def __init__(self, keys, offsets, targets, cumweights, probs, aliases):
+        self.keys = keys
+        self.offsets = offsets
+        self.targets = targets
+        self.cumweights = cumweights
+        self.probs = probs
+        self.aliases = aliases
+        self.overrides = {}
+
+    # Builds a table from (key, target, instances) tuples, in any order.
+    @classmethod
+    def from_edges(cls, edges):
+        keys, offsets, targets, cumweights = array('q'), array('q', [0]), array('q'), array('q')
+        probs, aliases = array('d'), array('q')
+        weights = []
+        def end_row():
+            row_probs, row_aliases = alias_table(weights)
+            probs.extend(row_probs)
+            aliases.extend(offsets[-1] + i for i in row_aliases)
+            offsets.append(len(targets))
+            weights.clear()
+
+        for key, target, instances in sorted(edges):
+            if not keys or keys[-1] != key:
+                if keys:
+                    end_row()
+                keys.append(key)
+                total = 0
+            total += instances
+            targets.append(target)
+            cumweights.append(total)
+            weights.append(instances)
+        if keys:
+            end_row()
+        return cls(keys, offsets, targets, cumweights, probs, aliases)
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Arrays mapped from a model file (see CompiledModel.load) can't be
+    # pickled, so they're copied.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in TABLE_ARRAYS:
+            if isinstance(state[name], memoryview):
+                state[name] = array(state[name].format, state[name])
+        return state
+
+    # Returns the row of the state with the given key, or -1 if it has no edges.
+    def find(self, key):
+        row = bisect_left(self.keys, key)
+        if row < len(self.keys) and self.keys[row] == key:
+            return row
+        return -1
+
+    # Picks the target of an edge out of the state at row, weighted by instances.
+    def sample(self, row, rng=random):
+        lo = self.offsets[row]
+        x = rng.random() * (self.offsets[row+1] - lo)
+        i = int(x)
+        # The fractional part of x decides between the edge and its alias
+        if x - i < self.probs[lo+i]:
+            return self.targets[lo+i]
+        return self.targets[self.aliases[lo+i]]
+
+    # Picks the target of an edge out of the state with the given key, or
+    # returns None if it has no edges.
+    def sample_key(self, key, rng=random):
+        if self.overrides:
+            state = self.overrides.get(key)
+            if state is not None:
+                targets, _, probs, aliases = state
+                x = rng.random() * len(targets)
+                i = int(x)
+                return targets[i] if x - i < probs[i] else targets[aliases[i]]
+        row = self.find(key)
+        return self.sample(row, rng) if row >= 0 else None
+
+    # Returns True if the state with the given key has any edges.
+    def has_state(self, key):
+        return key in self.overrides or self.find(key) >= 0
+
+    # Returns a dict of the instances of each edge out of the state with the
+    # given key.
+    def get_counts(self, key):
+        if key in self.overrides:
+            targets, weights, _, _ = self.overrides[key]
+            return dict(zip(targets, weights))
+        row = self.find(key)
+        if row < 0:
+            return {}
+        lo, hi = self.offsets[row], self.offsets[row+1]
+        counts = {}
+        for i in range(lo, hi):
+            counts[self.targets[i]] = self.cumweights[i] - (self.cumweights[i-1] if i > lo else 0)
+        return counts
+
+    # Yields (key, target, instances) for every edge.
+    def edges(self):
+        for row, key in enumerate(self.keys):
+            if key not in self.overrides:
+                lo, hi = self.offsets[row], self.offsets[row+1]
+                for i in range(lo, hi):
+                    yield key, self.targets[i], self.cumweights[i] - (self.cumweights[i-1] if i > lo else 0)
+        for key, (targets, weights, _, _) in self.overrides.items():
+            yield from ((key, target, n) for target, n in zip(targets, weights))
+
+    # Adds instances to edges, given as a dict of {target: instances} dicts
+    # keyed by state. Only the states in deltas get their alias tables rebuilt.
+    def add_counts(self, deltas):
+        for key, delta in deltas.items():
+            counts = self.get_counts(key)
+            for target, n in delta.items():
+                counts[target] = counts.get(target, 0) + n
+            targets, weights = list(counts), list(counts.values())
+            probs, aliases = alias_table(weights)
+            # Replaced in one go so generation never sees a half-updated state
+            self.overrides[key] = (targets, weights, probs, aliases)
+
+# Context keys are 63-bit FNV-1a hashes of the word ids of a context, with the
+# length of the context mixed into the top bits.
+KEY_OFFSET = 0xcbf29ce484222325 & (2**63 - 1)
+KEY_PRIME = 0x100000001b3
+KEY_MASK = 2**63 - 1
+
+# Returns the keys of the contexts made of the last 1, 2, ... len(ids) word
+# ids. The ids are hashed from the most recent one back, so every context's
+# key comes out of hashing the longest one.
+def context_keys(ids):
+    keys = []
+    h = KEY_OFFSET
+    for length, i in enumerate(reversed(ids), 1):
+        h = ((h ^ i) * KEY_PRIME) & KEY_MASK
+        keys.append(h ^ length << 58)
+    return keys
+
+# Returns the key of the context made of the given word ids.
+def context_key(ids):
+    return context_keys(ids)[-1]
+
+# Builds an alias table for the given weights with Vose's method. Returns the
+# probability of keeping each index, and the index to use otherwise.
+def alias_table(weights):
+    n, total = len(weights), sum(weights)
+    probs = [w * n / total for w in weights]
+    aliases = list(range(n))
+    small = [i for i, p in enumerate(probs) if p < 1]
+    large = [i for i, p in enumerate(probs) if p >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        aliases[s] = l
+        probs[l] -= 1 - probs[s]
+        if probs[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    # Whatever is left over is 1 up to rounding error
+    for i in small + large:
+        probs[i] = 1.0
+    return probs, aliases
+
+# An in-memory copy of a MarkovModel's edge tables. Words are replaced by ids
+# into a vocabulary list, and text is generated by walking the transition
+# table without touching the database. The table holds the contexts of every
+# length up to order.
+class CompiledModel:
+    def __init__(self, words, edges, order, first_states, start_ids, fallback_probability=0.2, beginning_word_probability=0.8):
+        # Ids that aren't used by any word are left as empty strings
+        self.words = words
+        self.word_ids = {word: i for i, word in enumerate(words) if word}
+        self.edges = edges
+        self.order = order
+        self.fallback_pr = fallback_probability
+        self.begin_word_pr = beginning_word_probability
+        self.is_punct = bytearray(word in PUNCTUATION for word in words)
+        self.is_end = bytearray(word in SENTENCE_ENDS for word in words)
+        # Censored version of each word, see censor_words
+        self.censored_words = None
+        self.censor_vowels_only = True
+        # Fingerprint of the database the model was saved from, see load
+        self.fingerprint = None
+
+        # Every word with outgoing edges, and every word following the end of a
+        # sentence
+        self.first_states = array('q', first_states)
+        self.start_set = set(start_ids)
+        # A sentence starts with a word that follows the end of a sentence with
+        # probability begin_word_pr, and with any word otherwise, retrying while
+        # it's punctuation. Precompute that distribution: pick from the
+        # non-punctuation words of one of the two lists, choosing the first
+        # list with probability start_word_pr.
+        self.start_ids = array('q', (i for i in start_ids if not self.is_punct[i]))
+        self.state_ids = array('q', (i for i in first_states if not self.is_punct[i]))
+        self._update_start_word_pr()
+
+    def _update_start_word_pr(self):
+        start_weight = self.begin_word_pr * len(self.start_ids) / len(self.start_set) if self.start_set else 0
+        state_weight = (1 - self.begin_word_pr) * len(self.state_ids) / len(self.first_states) if self.first_states else 0
+        self.start_word_pr = start_weight / (start_weight + state_weight) if start_weight else 0
+
+    # Loads the edge tables through the sqlite3 connection con.
+    @classmethod
+    def from_sqlite(cls, con, fallback_probability=0.2, beginning_word_probability=0.8):
+        cur = con.cursor()
+        order = cur.execute("select value from settings where name='order';").fetchone()[0]
+        # Context keys are made of vocab ids, so words keep their ids
+        max_id = cur.execute("select max(id) from vocab;").fetchone()[0]
+        words = [""] * (max_id + 1 if max_id is not None else 0)
+        for word_id, word in cur.execute("select id, word from vocab;"):
+            words[word_id] = word
+
+        edges = TransitionTable.from_edges(cur.execute("select context, nextid, instances from edges;"))
+        first_states = [currid for currid, in cur.execute("select currid from states where length=1 order by currid;")]
+        ends = [i for i, word in enumerate(words) if word and word in SENTENCE_ENDS]
+        start_ids = sorted(set(nxt for end in ends for nxt in edges.get_counts(context_key([end]))))
+        return cls(words, edges, order, first_states, start_ids, fallback_probability, beginning_word_probability)
+
+    # Writes the model to a binary file that load can map into memory.
+    # fingerprint is a pair of ints identifying the database contents.
+    def save(self, filename, fingerprint=(0, 0)):
+        # Edges learned since loading have to go into the arrays
+        edges = self.edges
+        if edges.overrides:
+            edges = TransitionTable.from_edges(edges.edges())
+        sections = [array('B', "\n".join(self.words).encode())]
+        sections.extend(getattr(edges, name) for name in TABLE_ARRAYS)
+        sections.append(self.first_states)
+        sections.append(array('q', sorted(self.start_set)))
+
+        with open(filename, "wb") as f:
+            f.write(MODEL_HEADER.pack(MODEL_MAGIC, MODEL_VERSION, len(sections), self.order, *fingerprint))
+            for section in sections:
+                # Arrays, or memoryviews of a loaded model
+                data = memoryview(section)
+                f.write(MODEL_SECTION.pack(data.format.encode(), len(data)))
+                f.write(data)
+                f.write(bytes(-data.nbytes % 8))
+
+    # Loads a model written by save. The file is memory-mapped and the
+    # transition table is read straight out of it, so loading doesn't depend
+    # on the number of edges and processes sharing a model share its pages.
+    @classmethod
+    def load(cls, filename, fallback_probability=0.2, beginning_word_probability=0.8):
+        with open(filename, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nsections, order, *fingerprint = MODEL_HEADER.unpack_from(buf)
+        if magic != MODEL_MAGIC or version != MODEL_VERSION:
+            raise ValueError("{} is not a version {} model file".format(filename, MODEL_VERSION))
+
+        view = memoryview(buf)
+        sections = []
+        pos = MODEL_HEADER.size
+        for _ in range(nsections):
+            typecode, count = MODEL_SECTION.unpack_from(buf, pos)
+            pos += MODEL_SECTION.size
+            typecode = typecode.decode()
+            size = count * struct.calcsize(typecode)
+            sections.append(view[pos:pos+size].cast(typecode))
+            pos += size + (-size % 8)
+
+        vocab = bytes(sections[0]).decode()
+        words = vocab.split("\n") if vocab else []
+        n = len(TABLE_ARRAYS)
+        edges = TransitionTable(*sections[1:1+n])
+        first_states, start_ids = sections[1+n:3+n]
+        model = cls(words, edges, order, first_states, start_ids, fallback_probability, beginning_word_probability)
+        model.fingerprint = tuple(fingerprint)
+        return model
+
+    # Censors every word of the vocabulary, so that text can be generated
+    # already censored (see iter_tokens).
+    def censor_words(self, vowels_only=True):
+        self.censored_words = [censorer.censor(word, vowels_only) for word in self.words]
+        self.censor_vowels_only = vowels_only
+
+    # Adds edge counts (see markov.count_edges) to the model in place, without
+    # rebuilding the tables of any other states. New words get ids in sorted
+    # order, the same as when the counts are written to the database.
+    def add_counts(self, counts):
+        for word in sorted(set(word for edge in counts[0] for word in edge)):
+            if word not in self.word_ids:
+                self._add_word(word)
+
+        ids = self.word_ids
+        deltas, first_deltas = {}, {}
+        for edge_counts in counts[:self.order]:
+            for edge, n in edge_counts.items():
+                *context, nxt = (ids[word] for word in edge)
+                delta = deltas.setdefault(context_key(context), {})
+                delta[nxt] = delta.get(nxt, 0) + n
+                if len(context) == 1:
+                    first_deltas[context[0]] = delta
+
+        # Keep the sentence start samplers up to date with new states and start words
+        for curr, delta in first_deltas.items():
+            if not self.edges.has_state(context_key([curr])):
+                self.first_states.append(curr)
+                if not self.is_punct[curr]:
+                    self.state_ids.append(curr)
+            if self.is_end[curr]:
+                for nxt in delta:
+                    if nxt not in self.start_set:
+                        self.start_set.add(nxt)
+                        if not self.is_punct[nxt]:
+                            self.start_ids.append(nxt)
+        self._update_start_word_pr()
+
+        self.edges.add_counts(deltas)
+
+    def _add_word(self, word):
+        self.word_ids[word] = len(self.words)
+        self.is_punct.append(word in PUNCTUATION)
+        self.is_end.append(word in SENTENCE_ENDS)
+        if self.censored_words is not None:
+            self.censored_words.append(censorer.censor(word, self.censor_vowels_only))
+        # Added last, so that everything else about the word is ready by the
+        # time generation can pick it
+        self.words.append(word)
+
+    # Picks a random non-punctuation word to start a sentence with.
+    def _random_start_id(self, rng=random):
+        ids = self.start_ids if rng.random() < self.start_word_pr else self.state_ids
+        return ids[int(rng.random() * len(ids))]
+
+    # Picks the word following the given word ids (most recent last), or None
+    # if the last one has no outgoing edges. Starting from the longest
+    # context, each context is used with probability 1 - fallback_pr if it has
+    # been seen, backing off to the next shorter one otherwise.
+    def _next_id(self, history, rng=random):
+        keys = context_keys(history)
+        for key in reversed(keys[1:]):
+            if rng.random() > self.fallback_pr:
+                nxt = self.edges.sample_key(key, rng)
+                if nxt is not None:
+                    return nxt
+        return self.edges.sample_key(keys[0], rng)
+
+    # Generates an endless stream of sentences, yielding a word (or punctuation
+    # mark) at a time. censored set to True yields the words censored by
+    # censor_words. See MarkovModel.iter_tokens.
+    def iter_tokens(self, init_prevword=None, rng=random, censored=False):
+        vocab = self.censored_words if censored else self.words
+        # The last order word ids, most recent last
+        history = [self.word_ids[init_prevword]] if init_prevword in self.word_ids else []
+        history.append(self._random_start_id(rng))
+        del history[:-self.order]
+        length = 0
+
+        while True:
+            curr = history[-1]
+            yield vocab[curr]
+
+            if self.is_end[curr]:
+                # Start another sentence, keeping the words before the end of
+                # the last one as context
+                history[-1] = self._random_start_id(rng)
+                length = 0
+                continue
+
+            length += 1
+            if length >= MAX_SENTENCE_LENGTH and "." in self.word_ids:
+                nxt = self.word_ids["."]
+            else:
+                nxt = self._next_id(history, rng)
+            if nxt is not None:
+                history.append(nxt)
+                if len(history) > self.order:
+                    del history[0]
+            else:
+                # Select new random word since we don't have one
+                states = self.first_states
+                history = [states[int(rng.random() * len(states))]]
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import os
+import sqlite3
+import sys
+
+from markov import create_tables, is_old_schema
+from markov_compiled import context_key
+
+OLD_TABLES = ["edges_first", "edges_second", "states_first", "states_second"]
+
+def err_msg():
+    print("Usage: {} <sqlite3 file> [sqlite3 file...]: upgrade markov dbs to the current schema".format(sys.argv[0]))
+
+# Upgrades a database with separate first- and second-order edge tables to the
+# schema where the edges out of every context share one table, keyed by
+# context. Both the original tables storing the words themselves and the
+# later ones with a vocab table and integer keys (version 1) are upgraded, to
+# a second-order model. Returns False if there was nothing to upgrade.
+def migrate(sqldb):
+    # Manage the transaction by hand so the whole upgrade is one transaction
+    con = sqlite3.connect(sqldb, isolation_level=None)
+    con.create_function("context_key", -1, lambda *ids: context_key(ids), deterministic=True)
+    try:
+        cur = con.cursor()
+        if not is_old_schema(cur):
+            return False
+        version = cur.execute("pragma user_version;").fetchone()[0]
+
+        cur.execute("begin;")
+        if version == 0:
+            # Number the words, and put the edges in the shape of version 1
+            cur.execute("alter table edges_first rename to word_edges_first;")
+            cur.execute("alter table edges_second rename to word_edges_second;")
+            create_tables(cur)
+            cur.execute("insert into vocab (word) select currword from word_edges_first union select nextword from word_edges_first;")
+            cur.execute("create temp table old_edges_first as "
+                "select c.id as currid, n.id as nextid, sum(e.instances) as instances from word_edges_first e "
+                "join vocab c on c.word = e.currword join vocab n on n.word = e.nextword group by c.id, n.id;")
+            cur.execute("create temp table old_edges_second as "
+                "select p.id as previd, c.id as currid, n.id as nextid, sum(e.instances) as instances from word_edges_second e "
+                "join vocab p on p.word = e.prevword join vocab c on c.word = e.currword join vocab n on n.word = e.nextword "
+                "group by p.id, c.id, n.id;")
+            cur.execute("create temp table old_states_first as select currid, sum(instances) as total from old_edges_first group by currid;")
+            cur.execute("create temp table old_states_second as "
+                "select previd, currid, sum(instances) as total from old_edges_second group by previd, currid;")
+            cur.execute("drop table word_edges_first;")
+            cur.execute("drop table word_edges_second;")
+        else:
+            # Move the old tables (and their indexes) out of the way
+            for table in OLD_TABLES:
+                cur.execute("alter table {0} rename to old_{0};".format(table))
+            create_tables(cur)
+
+        cur.execute("insert into edges (context, nextid, instances) "
+            "select context_key(currid), nextid, instances from old_edges_first;")
+        cur.execute("insert into edges (context, nextid, instances) "
+            "select context_key(previd, currid), nextid, instances from old_edges_second;")
+        cur.execute("insert into states (context, length, currid, total) "
+            "select context_key(currid), 1, currid, total from old_states_first;")
+        cur.execute("insert into states (context, length, currid, total) "
+            "select context_key(previd, currid), 2, currid, total from old_states_second;")
+        cur.execute("update settings set value = (select coalesce(sum(total), 0) from old_states_first) where name='instances';")
+
+        for table in OLD_TABLES:
+            cur.execute("drop table old_{};".format(table))
+        cur.execute("commit;")
+        # Give the space used by the old tables back
+        cur.execute("vacuum;")
+        return True
+
+    except sqlite3.Error as e:
+        print("Error:", e)
+        if con.in_transaction:
+            con.rollback()
+        return False
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for sqldb in sys.argv[1:]:
+            size = os.path.getsize(sqldb)
+            if migrate(sqldb):
+                print("{}: upgraded, {} -> {} bytes".format(sqldb, size, os.path.getsize(sqldb)))
+            else:
+                print("{}: not upgraded".format(sqldb))
+    else:
+        err_msg()
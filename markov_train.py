@@ -1,26 +1,47 @@
 #!/usr/bin/env python3
+import fileinput
 import sys
 
+import metrics
 from markov import MarkovModel
 
 def err_msg():
-    print("Usage: {} <sqlite3 file> <text file>: add text file to markov chain\n       {} <sqlite3 file> delete: delete markov db\n       {} <sqlite3 file> get s/p: get random sentence/paragraph".format(sys.argv[0], sys.argv[0], sys.argv[0]))
+    print("Usage: {} <sqlite3 file> [--order=N] <text file>...: add text files (- for stdin) to markov chain, creating it with order N (1-5, default 2)\n       {} <sqlite3 file> delete: delete markov db\n       {} <sqlite3 file> get s/p: get random sentence/paragraph\n       {} <sqlite3 file> export <model file>: write compiled binary model\n       {} <sqlite3 file> prune <min count>: drop contexts seen fewer than min count times\n       any of these can take --profile[=<file>] to dump cProfile stats and --metrics=<log|jsonl:file|prometheus:file> to record metrics".format(*[sys.argv[0]] * 5))
+
+def main(order=None):
+    mm = MarkovModel(sys.argv[1], order=order)
+    if len(sys.argv) == 3 and sys.argv[2] == "delete":
+        mm.delete_table()
+    elif len(sys.argv) == 4 and sys.argv[2] == "get":
+        if sys.argv[3] == "p":
+            print(mm.get_random_paragraph())
+        elif sys.argv[3] == "s":
+            print(mm.get_random_sentence())
+    elif len(sys.argv) == 4 and sys.argv[2] == "export":
+        mm.export_model(sys.argv[3])
+    elif len(sys.argv) == 4 and sys.argv[2] == "prune":
+        mm.prune(int(sys.argv[3]))
+    elif len(sys.argv) >= 3:
+        with fileinput.input(sys.argv[2:]) as f:
+            mm.train(l.replace("\r\n"," ").replace("\n"," ") for l in f)
+    else:
+        err_msg()
 
 if __name__ == "__main__":
+    order = None
+    for arg in sys.argv[2:]:
+        if arg.startswith("--order="):
+            order = int(arg[len("--order="):])
+            sys.argv.remove(arg)
+    try:
+        profile_to = metrics.parse_args(sys.argv)
+    except ValueError as e:
+        print("Error:", e)
+        sys.exit(1)
     if len(sys.argv) > 1:
-        mm = MarkovModel(sys.argv[1])
-        if len(sys.argv) == 3 and sys.argv[2] == "delete":
-            mm.delete_table()
-        elif len(sys.argv) == 4 and sys.argv[2] == "get":
-            if sys.argv[3] == "p":
-                print(mm.get_random_paragraph())
-            elif sys.argv[3] == "s":
-                print(mm.get_random_sentence())
-        elif len(sys.argv) == 3:
-            with open(sys.argv[2]) as f:
-                for l in f.readlines():
-                    mm.add_text(l.replace("\r\n"," ").replace("\n"," "))
+        if profile_to:
+            metrics.profile(main, order, filename=profile_to if profile_to is not True else None)
         else:
-            err_msg()
+            main(order)
     else:
         err_msg()
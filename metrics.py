@@ -0,0 +1,218 @@
+from contextlib import nullcontext
+from functools import wraps
+from time import perf_counter
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+# Opt-in counters and timers. Nothing is recorded until enable() is called;
+# until then every hook returns right away, and the hottest paths (per token)
+# check ENABLED once up front and skip their hooks entirely. Each process
+# keeps its own metrics, so work done in pool workers isn't counted.
+ENABLED = False
+_sink = None
+_lock = threading.Lock()
+# name -> count
+_counters = {}
+# name -> [calls, total seconds, max seconds]
+_timers = {}
+_flush_at_exit = False
+
+# Starts recording metrics, written to sink (a LogSink by default) by flush
+# and at exit.
+def enable(sink=None):
+    global ENABLED, _sink, _flush_at_exit
+    _sink = sink or LogSink()
+    ENABLED = True
+    if not _flush_at_exit:
+        atexit.register(flush)
+        _flush_at_exit = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+def count(name, n=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def add_time(name, seconds):
+    if not ENABLED:
+        return
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, perf_counter() - self.start)
+
+_NULL_TIMER = nullcontext()
+
+# Returns a context manager timing its block under name.
+def timer(name):
+    return _Timer(name) if ENABLED else _NULL_TIMER
+
+# Decorator timing every call of a function under name.
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_time(name, perf_counter() - start)
+        return wrapper
+    return decorator
+
+# Returns func, wrapped to time every call under name if metrics are enabled
+# right now. For functions called too often to check on every call.
+def wrap_timed(name, func):
+    return timed(name)(func) if ENABLED else func
+
+# Yields the items of iterable, timing how long each takes to produce under
+# name. Only worth wrapping an iterable in when metrics are enabled.
+def timed_iter(name, iterable):
+    it = iter(iterable)
+    while True:
+        start = perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        add_time(name, perf_counter() - start)
+        yield item
+
+# Returns the metrics recorded so far as a dict.
+def snapshot():
+    with _lock:
+        return {
+            "time": time.time(),
+            "counters": dict(_counters),
+            "timers": {name: {"calls": calls, "total": total, "max": longest}
+                for name, (calls, total, longest) in _timers.items()},
+        }
+
+# Writes the metrics recorded so far to the sink.
+def flush():
+    if _sink is not None and (_counters or _timers):
+        _sink.write(snapshot())
+
+# Prints metrics in a readable form to stream (stderr by default).
+class LogSink:
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, snap):
+        stream = self.stream or sys.stderr
+        print("Metrics at {}:".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snap["time"]))), file=stream)
+        for name, value in sorted(snap["counters"].items()):
+            print("  {:32} {:12}".format(name, value), file=stream)
+        for name, timer in sorted(snap["timers"].items()):
+            print("  {:32} {:12} calls {:12.3f} s total {:10.1f} us mean {:10.1f} us max".format(
+                name, timer["calls"], timer["total"], timer["total"] / timer["calls"] * 1e6, timer["max"] * 1e6), file=stream)
+
+# Appends metrics to a file as one JSON object per line.
+class JSONLinesSink:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, snap):
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(snap) + "\n")
+
+# Returns metrics in the Prometheus text exposition format. Counters become
+# <prefix>_<name>_total, and timers <prefix>_<name>_seconds summaries.
+def prometheus_text(snap, prefix="copypasta"):
+    lines = []
+    for name, value in sorted(snap["counters"].items()):
+        metric = _prometheus_name(prefix, name) + "_total"
+        lines += ["# TYPE {} counter".format(metric), "{} {}".format(metric, value)]
+    for name, timer in sorted(snap["timers"].items()):
+        metric = _prometheus_name(prefix, name) + "_seconds"
+        lines += ["# TYPE {} summary".format(metric),
+            "{}_count {}".format(metric, timer["calls"]),
+            "{}_sum {!r}".format(metric, timer["total"])]
+    return "\n".join(lines) + "\n"
+
+def _prometheus_name(prefix, name):
+    return re.sub(r"[^A-Za-z0-9_]", "_", prefix + "_" + name)
+
+# Writes metrics to a file in the Prometheus text format, replacing it each
+# time (e.g. for node_exporter's textfile collector).
+class PrometheusSink:
+    def __init__(self, filename, prefix="copypasta"):
+        self.filename = filename
+        self.prefix = prefix
+
+    def write(self, snap):
+        with open(self.filename + ".tmp", "w") as f:
+            f.write(prometheus_text(snap, self.prefix))
+        os.replace(self.filename + ".tmp", self.filename)
+
+# Returns the sink described by spec: "log", "jsonl:<file>" or
+# "prometheus:<file>". Raises ValueError for anything else.
+def sink_from_spec(spec):
+    kind, _, filename = spec.partition(":")
+    if kind == "log" and not filename:
+        return LogSink()
+    if kind == "jsonl" and filename:
+        return JSONLinesSink(filename)
+    if kind == "prometheus" and filename:
+        return PrometheusSink(filename)
+    raise ValueError("unknown metrics sink {!r}, expected log, jsonl:<file> or prometheus:<file>".format(spec))
+
+# Takes --metrics=<sink spec> and --profile[=<file>] out of argv (see
+# sink_from_spec and profile), enabling metrics if asked for. Returns the
+# profile filename, True to profile to stdout, or None not to profile.
+def parse_args(argv):
+    profile_to = None
+    for arg in argv[1:]:
+        if arg.startswith("--metrics="):
+            enable(sink_from_spec(arg[len("--metrics="):]))
+            argv.remove(arg)
+        elif arg == "--profile" or arg.startswith("--profile="):
+            profile_to = arg[len("--profile="):] if "=" in arg else True
+            argv.remove(arg)
+    return profile_to
+
+# Runs func(*args) under cProfile. The stats are dumped to filename (for
+# pstats or snakeviz) if given, and otherwise the top limit functions by
+# cumulative time are printed.
+def profile(func, *args, filename=None, limit=30):
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        if filename:
+            profiler.dump_stats(filename)
+        else:
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(limit)
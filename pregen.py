@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+from collections import deque
+from functools import partial
+import os
+import sys
+import threading
+import time
+
+def err_msg():
+    print("Usage: {} <spool dir> [capacity]: fill a spool of copypasta and memes and print its stats".format(sys.argv[0]))
+
+# Keeps up to capacity ready-made items (texts, or PNG data as bytes) so that
+# they can be handed out instantly. Items come from produce(n), which returns
+# a list of n of them; a background thread calls it whenever the buffer drops
+# below capacity, refilling up to batch_size items at a time. Given an
+# executor, produce runs in it rather than in the thread, which keeps
+# CPU-bound generation off this process.
+#
+# With spool_dir set, every item is also written to a file there until it's
+# handed out, so a restarted buffer starts off with whatever was left.
+class PregenBuffer:
+    def __init__(self, produce, capacity=32, spool_dir=None, batch_size=8, executor=None):
+        self.produce = produce
+        self.capacity = capacity
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.executor = executor
+        # (spool file or None, item) pairs, oldest first
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.seq = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.produced = 0
+        # Seconds from the buffer dropping below capacity to it being full again
+        self.last_refill_lag = 0.0
+        self.max_refill_lag = 0.0
+        self.total_refill_lag = 0.0
+        self.below_capacity_since = None
+
+        if spool_dir is not None:
+            self._load_spool()
+        self.thread = threading.Thread(target=self._refill, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Spool files are named by sequence number, so they sort oldest first.
+    # Anything half-written when the last process stopped is thrown away.
+    def _load_spool(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            self.items.append((path, data.decode() if name.endswith(".txt") else data))
+            self.seq = max(self.seq, int(name.split(".")[0]) + 1)
+
+    def _spool(self, item):
+        name = "{:012d}.{}".format(self.seq, "txt" if isinstance(item, str) else "bin")
+        self.seq += 1
+        path = os.path.join(self.spool_dir, name)
+        # Write under another name first so a crash never leaves a partial item
+        with open(path + ".tmp", "wb") as f:
+            f.write(item.encode() if isinstance(item, str) else item)
+        os.replace(path + ".tmp", path)
+        return path
+
+    def _refill(self):
+        while True:
+            with self.cond:
+                while not self.closed and len(self.items) >= self.capacity:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                n = min(self.batch_size, self.capacity - len(self.items))
+
+            try:
+                if self.executor is not None:
+                    items = self.executor.submit(self.produce, n).result()
+                else:
+                    items = self.produce(n)
+            except Exception as e:
+                print("Error:", e)
+                time.sleep(1)
+                continue
+            paths = [self._spool(item) if self.spool_dir is not None else None for item in items]
+
+            with self.cond:
+                self.items.extend(zip(paths, items))
+                self.produced += len(items)
+                if len(self.items) >= self.capacity and self.below_capacity_since is not None:
+                    lag = time.perf_counter() - self.below_capacity_since
+                    self.below_capacity_since = None
+                    self.refills += 1
+                    self.last_refill_lag = lag
+                    self.max_refill_lag = max(self.max_refill_lag, lag)
+                    self.total_refill_lag += lag
+                self.cond.notify_all()
+
+    # Returns a ready item, or None if there isn't one.
+    def try_get(self):
+        with self.cond:
+            if not self.items:
+                self.misses += 1
+                return None
+            path, item = self.items.popleft()
+            self.hits += 1
+            if self.below_capacity_since is None:
+                self.below_capacity_since = time.perf_counter()
+            self.cond.notify_all()
+        if path is not None:
+            os.remove(path)
+        return item
+
+    # Returns a ready item. If there isn't one, one is produced on the spot.
+    def get(self):
+        item = self.try_get()
+        if item is None:
+            item = self.produce(1)[0]
+        return item
+
+    # Waits until the buffer is full (or timeout seconds pass). Returns True
+    # if it's full.
+    def wait_full(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: len(self.items) >= self.capacity, timeout)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "ready": len(self.items),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0,
+                "produced": self.produced,
+                "refills": self.refills,
+                "last_refill_lag": self.last_refill_lag,
+                "mean_refill_lag": self.total_refill_lag / self.refills if self.refills else 0,
+                "max_refill_lag": self.max_refill_lag,
+            }
+
+if __name__ == "__main__":
+    if len(sys.argv) in (2, 3):
+        import copypasta
+        capacity = int(sys.argv[2]) if len(sys.argv) == 3 else 32
+        buffers = {
+            "copypasta": PregenBuffer(partial(copypasta.generate_batch, processes=1), capacity, os.path.join(sys.argv[1], "copypasta")),
+            "meme": PregenBuffer(copypasta.generate_memes, capacity, os.path.join(sys.argv[1], "meme")),
+        }
+        for name, buffer in buffers.items():
+            start = time.perf_counter()
+            buffer.wait_full()
+            buffer.close()
+            print("{}: full in {:.2f} s, {}".format(name, time.perf_counter() - start, buffer.stats()))
+    else:
+        err_msg()
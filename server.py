@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+import asyncio
+import json
+import os
+import sys
+
+import copypasta
+import metrics
+from pregen import PregenBuffer
+
+# Requests for the same kind of output that come in within BATCH_WAIT seconds
+# of each other are generated together, up to BATCH_SIZE at a time. Memes
+# take long enough to render that batching them would only hold finished ones
+# back, so they go one at a time.
+BATCH_SIZE = 16
+MEME_BATCH_SIZE = 1
+BATCH_WAIT = 0.005
+# Requests waiting for a batch beyond this many get a 503 rather than queueing
+# up forever.
+MAX_PENDING = 256
+KEEP_ALIVE_TIMEOUT = 30
+# Generate n outputs of each kind
+PRODUCERS = {
+    "copypasta": copypasta.generate_batch,
+    "meme": copypasta.generate_memes,
+}
+STATUS_LINES = {
+    200: "200 OK",
+    400: "400 Bad Request",
+    404: "404 Not Found",
+    405: "405 Method Not Allowed",
+    500: "500 Internal Server Error",
+    503: "503 Service Unavailable",
+}
+
+def err_msg():
+    print("Usage: {} [--metrics=<sink>] [port] [processes] [buffer size] [spool dir]: serve copypasta and memes over HTTP on localhost (default port 8080),\n       keeping buffer size of each ready ahead of time, and metrics at /metrics (see metrics.parse_args)".format(sys.argv[0]))
+
+# Collects requests for one kind of output and runs them through func(n) in
+# the executor in batches, so a burst of requests costs one trip to a worker
+# process rather than one each. slots limits the number of batches running at
+# once across all batchers; while they're all taken, requests queue up until
+# there are max_pending of them.
+class Batcher:
+    def __init__(self, executor, slots, func, max_size=BATCH_SIZE, max_wait=BATCH_WAIT, max_pending=MAX_PENDING):
+        self.executor = executor
+        self.slots = slots
+        self.func = func
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue(max_pending)
+        self.batches = 0
+        self.batched = 0
+
+    # Returns a future for one output. Raises asyncio.QueueFull if too many
+    # requests are waiting already.
+    def submit(self):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(future)
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            # Requests whose clients went away don't need generating
+            batch = [future for future in batch if not future.done()]
+            if not batch:
+                continue
+
+            await self.slots.acquire()
+            self.batches += 1
+            self.batched += len(batch)
+            job = loop.run_in_executor(self.executor, self.func, len(batch))
+            job.add_done_callback(lambda job, batch=batch: self._finish(job, batch))
+
+    def _finish(self, job, batch):
+        self.slots.release()
+        for i, future in enumerate(batch):
+            if future.done():
+                continue
+            if job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result()[i])
+
+    def stats(self):
+        return {
+            "pending": self.queue.qsize(),
+            "batches": self.batches,
+            "mean_batch_size": self.batched / self.batches if self.batches else 0,
+        }
+
+# Serves copypasta and memes generated in a pool of processes. With
+# buffer_size set, that many of each kind are kept ready in PregenBuffers
+# (spooled to subdirectories of spool_dir, if given), and only requests that
+# find their buffer empty wait for generation.
+class Server:
+    def __init__(self, processes=None, buffer_size=0, spool_dir=None):
+        processes = processes or os.cpu_count() or 1
+        # Load the model before the workers fork so they all share it
+        copypasta.PASTA_MM.get_compiled_model()
+        self.executor = ProcessPoolExecutor(processes)
+        self.processes = processes
+        self.batchers = {}
+        self.buffers = {}
+        self.served = 0
+        self.rejected = 0
+        self.abandoned = 0
+
+        if buffer_size:
+            for kind in PRODUCERS:
+                for short in (False, True):
+                    name = kind + ("_short" if short else "")
+                    self.buffers[kind, short] = PregenBuffer(
+                        partial(PRODUCERS[kind], short=short, processes=1), buffer_size,
+                        os.path.join(spool_dir, name) if spool_dir else None, executor=self.executor)
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        # Twice as many batches as workers keeps them busy without letting
+        # the executor's own queue grow unbounded
+        slots = asyncio.Semaphore(2 * self.processes)
+        for kind in PRODUCERS:
+            for short in (False, True):
+                # Module functions, so they can be pickled over to the workers
+                self.batchers[kind, short] = Batcher(self.executor, slots, partial(PRODUCERS[kind], short=short, processes=1),
+                    max_size=MEME_BATCH_SIZE if kind == "meme" else BATCH_SIZE)
+        tasks = [asyncio.create_task(batcher.run()) for batcher in self.batchers.values()]
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print("Serving on http://{}:{}/ with {} processes".format(host, port, self.processes))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            for buffer in self.buffers.values():
+                buffer.close()
+            self.executor.shutdown(cancel_futures=True)
+
+    async def handle_connection(self, reader, writer):
+        # The start of the next request, if it came in while responding
+        leftover = b""
+        try:
+            while True:
+                request_line = leftover
+                leftover = b""
+                if not request_line.endswith(b"\n"):
+                    try:
+                        request_line += await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        break
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                # None of the endpoints take a body, but it has to be read
+                # to get to the next request
+                if "content-length" in headers:
+                    await reader.readexactly(int(headers["content-length"]))
+
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    status, content_type, body = 400, "text/plain", b"Bad request\n"
+                    version = "HTTP/1.0"
+                else:
+                    method, target, version = parts
+                    with metrics.timer("server.respond"):
+                        response = asyncio.ensure_future(self.respond(method, target))
+                        leftover = await self.watch_client(reader, response)
+                    if response.cancelled():
+                        break
+                    status, content_type, body = response.result()
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                head = ["HTTP/1.1 " + STATUS_LINES[status],
+                    "Content-Type: " + content_type,
+                    "Content-Length: " + str(len(body)),
+                    "Connection: " + ("keep-alive" if keep_alive else "close")]
+                if status == 503:
+                    head.append("Retry-After: 1")
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Waits for response, and cancels it if the client hangs up first, which
+    # also takes the request out of its batch if it hasn't started yet. Returns
+    # the first byte of the client's next request if it came in meanwhile.
+    async def watch_client(self, reader, response):
+        hangup = asyncio.ensure_future(reader.read(1))
+        await asyncio.wait((response, hangup), return_when=asyncio.FIRST_COMPLETED)
+        if response.done():
+            hangup.cancel()
+            try:
+                return await hangup
+            except asyncio.CancelledError:
+                return b""
+        data = hangup.result()
+        if not data:
+            self.abandoned += 1
+            metrics.count("server.abandoned")
+            response.cancel()
+            try:
+                await response
+            except asyncio.CancelledError:
+                pass
+            return b""
+        await response
+        return data
+
+    # Returns the status, content type and body of the response to a request.
+    async def respond(self, method, target):
+        url = urlsplit(target)
+        if method != "GET":
+            return 405, "text/plain", b"Only GET is supported\n"
+        if url.path == "/stats":
+            return 200, "application/json", json.dumps(self.stats()).encode()
+        if url.path == "/metrics":
+            # Only this process's; generation happens in the workers
+            return 200, "text/plain; version=0.0.4", metrics.prometheus_text(metrics.snapshot()).encode()
+        if url.path not in ("/copypasta", "/meme"):
+            return 404, "text/plain", b"Not found\n"
+
+        short = parse_qs(url.query).get("short", ["0"])[0] not in ("0", "false", "")
+        key = url.path[1:], short
+        result = self.buffers[key].try_get() if key in self.buffers else None
+        if result is not None:
+            metrics.count("server.buffer_hits")
+        else:
+            try:
+                future = self.batchers[key].submit()
+            except asyncio.QueueFull:
+                self.rejected += 1
+                metrics.count("server.rejected")
+                return 503, "text/plain", b"Too many requests, try again later\n"
+            try:
+                result = await future
+            except Exception as e:
+                print("Error:", e)
+                return 500, "text/plain", b"Generation failed\n"
+        self.served += 1
+        metrics.count("server.served")
+        if url.path == "/meme":
+            return 200, "image/png", result
+        return 200, "text/plain; charset=utf-8", result.encode() + b"\n"
+
+    def stats(self):
+        return {
+            "served": self.served,
+            "rejected": self.rejected,
+            "abandoned": self.abandoned,
+            "batchers": {"{}{}".format(kind, " (short)" if short else ""): batcher.stats()
+                for (kind, short), batcher in self.batchers.items()},
+            "buffers": {"{}{}".format(kind, " (short)" if short else ""): buffer.stats()
+                for (kind, short), buffer in self.buffers.items()},
+        }
+
+if __name__ == "__main__":
+    try:
+        metrics.parse_args(sys.argv)
+    except ValueError as e:
+        print("Error:", e)
+        sys.exit(1)
+    if len(sys.argv) <= 5:
+        try:
+            port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+            processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+            buffer_size = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        except ValueError:
+            err_msg()
+            sys.exit(1)
+        spool_dir = sys.argv[4] if len(sys.argv) > 4 else None
+        try:
+            asyncio.run(Server(processes, buffer_size, spool_dir).serve(port=port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        err_msg()
@@ -0,0 +1,44 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import json
+import random
+import threading
+import time
+
+# Stands in for image search and image hosts, with NETWORK_LATENCY seconds of
+# delay on every response. /search?q= returns a JSON list of url, type pairs,
+# a quarter of which are dead links, and /img/<n>.png a PNG image.
+class StandInHandler(BaseHTTPRequestHandler):
+    NETWORK_LATENCY = 0.05
+    PNG = None
+
+    def do_GET(self):
+        time.sleep(self.NETWORK_LATENCY)
+        url = urlsplit(self.path)
+        if url.path == "/search":
+            query = parse_qs(url.query)["q"][0]
+            rng = random.Random(query)
+            results = [("http://{}:{}/{}/{}.png".format(*self.server.server_address, "dead" if i % 4 == 0 else "img", rng.getrandbits(32)), "png")
+                for i in range(8)]
+            self._send(200, "application/json", json.dumps(results).encode())
+        elif url.path.startswith("/img/"):
+            self._send(200, "image/png", self.PNG)
+        else:
+            self._send(404, "text/plain", b"Not found\n")
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serves handler on a free local port from a daemon thread. Returns the server
+# and its base url; call server.shutdown() when done with it.
+def start(handler=StandInHandler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://{}:{}".format(*server.server_address)
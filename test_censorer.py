@@ -0,0 +1,46 @@
+import random
+import re
+
+import pytest
+
+import censorer
+
+# Censors text a word at a time in list order, the way censorer used to
+def censor_word_by_word(text, words, vowels_only=True):
+    for word in words:
+        if word:
+            text = re.sub(re.escape(word), censorer._get_censored_word(word, vowels_only), text, flags=re.IGNORECASE)
+    return text
+
+@pytest.fixture
+def censor_words():
+    saved = list(censorer._censor_words)
+    yield
+    censorer.set_censor_words(saved, replace=True)
+
+@pytest.mark.parametrize("text, expected", [
+    ("shitwat", "sh*tw*t"),
+    ("analabia", "*n*l*b**"),
+    ("what a goddamn mess", "what a godd*mn mess"),
+    ("ſex", "s*x"),
+    ("ſhit happens", "sh*t happens"),
+    ("nothing to see here", "nothing to see here"),
+])
+def test_default_list(censor_words, text, expected):
+    censorer.set_censor_words(None, replace=True)
+    assert censorer.censor(text) == expected
+
+def test_spanning_only(censor_words):
+    censorer.set_censor_words(["blow job", "job"], replace=True)
+    assert censorer.censor("a blow job for the job", spanning_only=True) == "a bl*w j*b for the job"
+
+# Overlapping, nested and duplicate words from a tiny alphabet, so they run
+# into each other as often as possible
+def test_matches_word_by_word(censor_words):
+    rng = random.Random(0)
+    for _ in range(5000):
+        words = ["".join(rng.choice("abAe") for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 5))]
+        text = "".join(rng.choice("abAe ſ") for _ in range(rng.randint(0, 20)))
+        vowels_only = rng.random() < 0.5
+        censorer.set_censor_words(words, replace=True)
+        assert censorer.censor(text, vowels_only) == censor_word_by_word(text, words, vowels_only), (words, text)
@@ -0,0 +1,164 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import json
+import threading
+import urllib.error
+
+from PIL import Image
+import pytest
+
+import image_cache
+from stand_in_server import StandInHandler
+import stand_in_server
+
+# An 8x8 RGB PNG in a shade depending on n, so every image is different
+def png(n):
+    f = BytesIO()
+    Image.new("RGB", (8, 8), (n % 256, n // 256 % 256, 0)).save(f, "PNG")
+    return f.getvalue()
+
+IMAGE_BYTES = 8 * 8 * 3
+
+# StandInHandler, counting requests by path, with images that differ by
+# number, /status/<code> answering with that status and /flaky/<n>/<key>
+# failing with 503 n times before answering with an image
+class CountingHandler(StandInHandler):
+    NETWORK_LATENCY = 0.02
+    hits = Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            self.hits[self.path] += 1
+            hits = self.hits[self.path]
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "img":
+            self._send(200, "image/png", png(int(parts[1].split(".")[0])))
+        elif parts[0] == "status":
+            self._send(int(parts[1]), "text/plain", b"Status\n")
+        elif parts[0] == "flaky":
+            if hits <= int(parts[1]):
+                self._send(503, "text/plain", b"Try again\n")
+            else:
+                self._send(200, "image/png", png(0))
+        else:
+            super().do_GET()
+
+@pytest.fixture(scope="module")
+def server():
+    server, url = stand_in_server.start(CountingHandler)
+    yield url
+    server.shutdown()
+
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
+    CountingHandler.hits.clear()
+    monkeypatch.setattr(image_cache, "RETRY_BACKOFF", 0.01)
+
+def test_fetch_retries_429_and_5xx(server):
+    assert image_cache.fetch(server + "/flaky/2/a") == png(0)
+    assert CountingHandler.hits["/flaky/2/a"] == 3
+    with pytest.raises(urllib.error.HTTPError):
+        image_cache.fetch(server + "/flaky/5/b", retries=2)
+    assert CountingHandler.hits["/flaky/5/b"] == 3
+    with pytest.raises(urllib.error.HTTPError):
+        image_cache.fetch(server + "/status/429", retries=1)
+    assert CountingHandler.hits["/status/429"] == 2
+
+def test_fetch_doesnt_retry_other_errors(server):
+    with pytest.raises(urllib.error.HTTPError):
+        image_cache.fetch(server + "/status/404")
+    assert CountingHandler.hits["/status/404"] == 1
+
+def test_memory_evicts_least_recently_used(server):
+    cache = image_cache.ImageCache(max_memory_bytes=2 * IMAGE_BYTES)
+    cache.get_image(server + "/img/1.png")
+    cache.get_image(server + "/img/2.png")
+    cache.get_image(server + "/img/1.png")
+    cache.get_image(server + "/img/3.png")
+    assert list(cache.memory) == [server + "/img/1.png", server + "/img/3.png"]
+    assert cache.memory_bytes == 2 * IMAGE_BYTES
+    assert cache.stats()["memory_hits"] == 1
+    assert cache.get_image(server + "/img/2.png") is not None
+    assert CountingHandler.hits["/img/2.png"] == 2
+
+def test_disk_evicts_least_recently_used(server, tmp_path):
+    size = len(png(1))
+    cache = image_cache.ImageCache(tmp_path, max_memory_bytes=0, max_disk_bytes=2 * size)
+    for n in (1, 2, 1, 3):
+        cache.get_image(server + "/img/{}.png".format(n))
+    assert len(cache.objects) == 2 and cache.disk_bytes <= 2 * size
+    assert len(list((tmp_path / "objects").iterdir())) == 2
+    # 2 was used least recently, so it's the one downloaded again
+    cache.get_image(server + "/img/1.png")
+    cache.get_image(server + "/img/2.png")
+    assert CountingHandler.hits["/img/1.png"] == 1
+    assert CountingHandler.hits["/img/2.png"] == 2
+
+def test_reloads_from_disk(server, tmp_path):
+    url = server + "/img/7.png"
+    image_cache.ImageCache(tmp_path).get_image(url)
+    cache = image_cache.ImageCache(tmp_path)
+    img = cache.get_image(url)
+    assert img.getpixel((0, 0)) == (7, 0, 0)
+    assert cache.stats()["disk_hits"] == 1 and cache.stats()["downloads"] == 0
+    assert CountingHandler.hits["/img/7.png"] == 1
+
+def test_concurrent_requests_share_a_download(server):
+    cache = image_cache.ImageCache()
+    with ThreadPoolExecutor(8) as executor:
+        imgs = list(executor.map(cache.get_image, [server + "/img/5.png"] * 8))
+    assert all(img is imgs[0] for img in imgs)
+    assert CountingHandler.hits["/img/5.png"] == 1
+
+def test_failures_arent_retried_within_ttl(server):
+    cache = image_cache.ImageCache(fetch=lambda url: image_cache.fetch(url, retries=0))
+    assert cache.get_image(server + "/status/404") is None
+    assert cache.get_image(server + "/status/404") is None
+    assert CountingHandler.hits["/status/404"] == 1
+    cache.failure_ttl = 0
+    assert cache.get_image(server + "/status/404") is None
+    assert CountingHandler.hits["/status/404"] == 2
+
+def search_for(server):
+    calls = []
+    def search(query):
+        calls.append(query)
+        return [tuple(result) for result in json.loads(image_cache.fetch(server + "/search?q=" + query))]
+    return search, calls
+
+def test_search_cache_ttl(server):
+    search, calls = search_for(server)
+    cache = image_cache.SearchCache(search)
+    results = cache.get("cats")
+    assert len(results) == 8
+    assert cache.get(" CATS ") == results
+    assert calls == ["cats"]
+    cache.ttl = 0
+    assert cache.get("cats") == results
+    assert calls == ["cats", "cats"]
+    assert cache.stats() == {"queries": 1, "hits": 1, "misses": 2}
+
+def test_search_cache_skips_empty_results():
+    calls = []
+    cache = image_cache.SearchCache(lambda query: calls.append(query) or [])
+    assert cache.get("nothing") == []
+    assert cache.get("nothing") == []
+    assert len(calls) == 2
+
+def test_search_cache_reloads_from_disk(server, tmp_path):
+    search, calls = search_for(server)
+    results = image_cache.SearchCache(search, tmp_path).get("dogs")
+    assert image_cache.SearchCache(search, tmp_path).get("dogs") == results
+    assert calls == ["dogs"]
+
+def test_prefetcher_first_image(server):
+    cache = image_cache.ImageCache()
+    urls = [server + "/status/404", server + "/img/9.png", server + "/img/10.png"]
+    with image_cache.Prefetcher(cache) as prefetcher:
+        url, img = prefetcher.first_image(urls)
+        assert url in urls[1:] and img is not None
+        assert all(future.result() is not None for future in prefetcher.prefetch(urls[1:]))
+        assert prefetcher.first_image([server + "/status/404"]) == (None, None)
+    assert set(cache.memory) == set(urls[1:])
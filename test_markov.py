@@ -0,0 +1,23 @@
+import threading
+
+import markov
+from markov_compiled import CompiledModel
+
+# A flush landing while the compiled model loads used to take the pending
+# counts after the load had read the database, leaving them out of both
+def test_flush_during_load_keeps_learned_counts(tmp_path, monkeypatch):
+    from_sqlite = CompiledModel.from_sqlite.__func__
+    flushers = []
+    with markov.MarkovModel(str(tmp_path / "test.sqlite3"), censor=False, compiled=True) as mm:
+        def load_then_flush(cls, *args):
+            model = from_sqlite(cls, *args)
+            flushers.append(threading.Thread(target=mm.flush))
+            flushers[-1].start()
+            # Long enough for the flush to go through unless it's held back
+            flushers[-1].join(0.2)
+            return model
+        monkeypatch.setattr(CompiledModel, "from_sqlite", classmethod(load_then_flush))
+        mm.add_texts(["the cat sat on the mat."])
+        mm.learn_texts(["the zebra sat on the cat."])
+        assert "zebra" in mm.get_compiled_model().word_ids
+        flushers[-1].join()